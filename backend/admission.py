@@ -0,0 +1,246 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "8"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_MAX_QUEUE_WAIT_S = float(os.getenv("ADMISSION_MAX_QUEUE_WAIT_S", "30"))
+SESSION_RATE_PER_MIN = float(os.getenv("SESSION_RATE_PER_MIN", "20"))
+SESSION_BURST = int(os.getenv("SESSION_BURST", "5"))
+IP_RATE_PER_MIN = float(os.getenv("IP_RATE_PER_MIN", "60"))
+IP_BURST = int(os.getenv("IP_BURST", "20"))
+
+# Lower value = served first. Queries beat ingestion.
+PRIORITY_QUERY = 0
+PRIORITY_INGEST = 1
+
+# Bound on the number of per-session / per-IP buckets kept in memory.
+_MAX_BUCKETS = 10_000
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is shed; `retry_after` is in whole seconds.
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, retry_after)
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `capacity` tokens, refilled at `rate` tokens/second.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Takes a token. Returns 0 on success, otherwise the seconds until one
+        becomes available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class _BucketMap:
+    """
+    LRU-bounded map of key -> TokenBucket.
+    """
+
+    def __init__(self, rate_per_min: float, burst: int):
+        self._rate = rate_per_min / 60.0
+        self._burst = burst
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def take(self, key: str) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self._rate, self._burst)
+            self._buckets[key] = bucket
+            if len(self._buckets) > _MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(key)
+        return bucket.take()
+
+
+@dataclass
+class Ticket:
+    """
+    Proof of admission; hand it back to `AdmissionController.release`.
+    """
+
+    priority: int
+    admitted_at: float
+    queue_wait: float
+    released: bool = False
+
+
+class AdmissionController:
+    """
+    Admission control in front of the expensive endpoints:
+
+    * per-session and per-IP token buckets reject bursts immediately;
+    * at most `max_in_flight` requests run at once;
+    * the rest wait in a bounded priority queue (queries before ingestion);
+    * requests are shed with a Retry-After hint when the queue is full, the
+      expected wait exceeds `max_queue_wait`, or they have actually waited
+      that long.
+
+    State is per process; with several workers each one enforces its own cap.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        max_queue_wait: float = ADMISSION_MAX_QUEUE_WAIT_S,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self._in_flight = 0
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._session_buckets = _BucketMap(SESSION_RATE_PER_MIN, SESSION_BURST)
+        self._ip_buckets = _BucketMap(IP_RATE_PER_MIN, IP_BURST)
+        # Exponentially-weighted averages used for Retry-After estimates.
+        self._avg_service_time = 5.0
+        self._avg_queue_wait = 0.0
+        self._stats = {
+            "admitted_total": 0,
+            "queued_total": 0,
+            "rejected_rate_limited_total": 0,
+            "rejected_queue_full_total": 0,
+            "rejected_queue_timeout_total": 0,
+            "max_queue_wait_seconds": 0.0,
+        }
+
+    def _queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._queue if not future.done())
+
+    def _expected_wait(self, depth: int) -> float:
+        return (depth + 1) * self._avg_service_time / self.max_in_flight
+
+    def _check_rate_limits(self, session_id: Optional[str], client_ip: Optional[str]):
+        for buckets, key in (
+            (self._session_buckets, session_id),
+            (self._ip_buckets, client_ip),
+        ):
+            if not key:
+                continue
+            wait = buckets.take(key)
+            if wait > 0:
+                self._stats["rejected_rate_limited_total"] += 1
+                raise AdmissionRejected("Rate limit exceeded", int(wait) + 1)
+
+    async def acquire(
+        self,
+        priority: int,
+        session_id: Optional[str] = None,
+        client_ip: Optional[str] = None,
+    ) -> Ticket:
+        """
+        Waits for an execution slot. Raises `AdmissionRejected` when the
+        request is rate limited or shed.
+        """
+        self._check_rate_limits(session_id, client_ip)
+        started = time.monotonic()
+
+        if self._in_flight < self.max_in_flight and not self._queue_depth():
+            self._in_flight += 1
+            return self._admit(priority, started)
+
+        depth = self._queue_depth()
+        expected_wait = self._expected_wait(depth)
+        if depth >= self.max_queue or expected_wait > self.max_queue_wait:
+            self._stats["rejected_queue_full_total"] += 1
+            raise AdmissionRejected("Server is busy", int(expected_wait) + 1)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), future))
+        self._stats["queued_total"] += 1
+        try:
+            # The slot is transferred to us by `release`, so no increment here.
+            await asyncio.wait({future}, timeout=self.max_queue_wait)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # We were handed a slot just as we were cancelled; pass it on.
+                self._hand_off()
+            future.cancel()
+            raise
+        if not future.done():
+            # Cancelling the future makes `release` skip it.
+            future.cancel()
+            self._stats["rejected_queue_timeout_total"] += 1
+            raise AdmissionRejected(
+                "Server is busy", int(self._expected_wait(self._queue_depth())) + 1
+            )
+        return self._admit(priority, started)
+
+    def _admit(self, priority: int, started: float) -> Ticket:
+        now = time.monotonic()
+        wait = now - started
+        self._stats["admitted_total"] += 1
+        self._avg_queue_wait = 0.9 * self._avg_queue_wait + 0.1 * wait
+        self._stats["max_queue_wait_seconds"] = max(
+            self._stats["max_queue_wait_seconds"], wait
+        )
+        return Ticket(priority=priority, admitted_at=now, queue_wait=wait)
+
+    def release(self, ticket: Ticket):
+        """
+        Frees the ticket's slot, handing it directly to the next waiter.
+        Safe to call more than once.
+        """
+        if ticket.released:
+            return
+        ticket.released = True
+        service_time = time.monotonic() - ticket.admitted_at
+        self._avg_service_time = 0.9 * self._avg_service_time + 0.1 * service_time
+        self._hand_off()
+
+    def _hand_off(self):
+        """
+        Passes a freed slot to the next live waiter, or returns it to the pool.
+        """
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def metrics(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queue_depth": self._queue_depth(),
+            "max_queue": self.max_queue,
+            "avg_queue_wait_seconds": round(self._avg_queue_wait, 4),
+            "avg_service_time_seconds": round(self._avg_service_time, 4),
+            **self._stats,
+        }
+
+
+admission = AdmissionController()
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Unset (or "memory://") keeps the cache in-process, which is only correct
+# with a single worker. Point it at Redis (or anything speaking the Redis
+# protocol, e.g. a local Valkey / KeyDB) to share it between workers and hosts.
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "rag:")
+
+
+class Cache:
+    """
+    Minimal key/value interface for state that must be shared between
+    workers. Values are JSON-serialisable; `ttl_s` is in seconds.
+    """
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl_s: Optional[float] = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+
+class InMemoryCache(Cache):
+    """
+    Per-process LRU with optional expiry. The default, for a single worker.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        # Round-trip through JSON so callers can't mutate the stored value,
+        # matching the Redis backend.
+        return json.loads(value)
+
+    def set(self, key, value, ttl_s=None):
+        expires_at = time.monotonic() + ttl_s if ttl_s else None
+        with self._lock:
+            self._entries[key] = (json.dumps(value), expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisCache(Cache):
+    """
+    Cache shared by every worker and host through a Redis-protocol server.
+    Entries without a TTL rely on the server's eviction policy (e.g.
+    `maxmemory-policy allkeys-lru`).
+    """
+
+    def __init__(self, url: str, prefix: str = CACHE_KEY_PREFIX):
+        import redis
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=2.0)
+
+    def get(self, key):
+        value = self._client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl_s=None):
+        self._client.set(
+            self.prefix + key,
+            json.dumps(value),
+            px=int(ttl_s * 1000) if ttl_s else None,
+        )
+
+    def delete(self, key):
+        self._client.delete(self.prefix + key)
+
+
+_cache: Optional[Cache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Cache:
+    """
+    Returns the process-wide cache selected by CACHE_URL, creating it on first use.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            if CACHE_URL and not CACHE_URL.startswith("memory://"):
+                print("Using shared Redis cache.")
+                _cache = RedisCache(CACHE_URL)
+            else:
+                _cache = InMemoryCache()
+        return _cache
@@ -0,0 +1,554 @@
+"""
+Structure-aware, token-based document chunking.
+
+Chunks follow the document's headings, paragraphs and tables, are sized in
+tokens of the embedding model's own tokenizer, and carry page and section
+metadata. Run as a script to compare against the old character splitter:
+
+    python -m backend.chunking report path/to/file.pdf [--qa qa.jsonl --k 10 --lexical]
+"""
+
+import os
+import re
+import json
+import math
+import zlib
+import argparse
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+
+# all-MiniLM-L6-v2 truncates its input at 256 word pieces (including the two
+# special tokens), so anything past that would never be embedded.
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "250"))
+# A heading only starts a new chunk once the current one has this many
+# tokens, so short sections are merged into the following one rather than
+# becoming small chunks of their own.
+CHUNK_MIN_TOKENS = int(os.getenv("CHUNK_MIN_TOKENS", "160"))
+# A paragraph that doesn't fit is split at a sentence boundary to top up the
+# current chunk, if at least this much room is left.
+CHUNK_MIN_FILL_TOKENS = 32
+
+# Vector hierarchy levels, stored as the "level" metadata field.
+LEVEL_DOCUMENT = "document"
+LEVEL_SECTION = "section"
+LEVEL_CHUNK = "chunk"
+
+_MARKDOWN_HEADING = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_NUMBERED_HEADING = re.compile(r"^((?:\d+\.)*\d+)\.?\s+([A-Z][^.!?]{1,80})$")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+@dataclass
+class Block:
+    """
+    A structural unit of a document: a heading, a paragraph or a table.
+    """
+
+    kind: str
+    text: str
+    page: Optional[int]
+    section: str
+    tokens: int = 0
+
+
+@lru_cache(maxsize=1)
+def _get_tokenizer():
+    """
+    Loads (once) the embedding model's fast tokenizer. Returns None when it
+    can't be loaded, in which case token counts are estimated.
+    """
+    try:
+        from tokenizers import Tokenizer
+
+        tokenizer = Tokenizer.from_pretrained(EMBEDDING_MODEL_NAME)
+        tokenizer.no_truncation()
+        tokenizer.no_padding()
+        return tokenizer
+    except Exception as e:
+        print(
+            f"Warning: could not load tokenizer for {EMBEDDING_MODEL_NAME} ({e}); "
+            "falling back to estimated token counts."
+        )
+        return None
+
+
+def warm_up():
+    """
+    Loads the tokenizer ahead of the first ingestion; on a cold cache this
+    downloads it from the Hugging Face Hub, which can take a while (or time
+    out when offline). Blocking; run it off the event loop.
+    """
+    count_tokens(["warm-up"])
+
+
+def count_tokens(texts: List[str]) -> List[int]:
+    """
+    Counts tokens for a batch of texts in a single (parallel) tokenizer call.
+    """
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return [(len(text) + 3) // 4 for text in texts]
+    # encode_batch_fast skips offset tracking, which we don't need for counts.
+    encode = getattr(tokenizer, "encode_batch_fast", tokenizer.encode_batch)
+    return [len(encoding.ids) for encoding in encode(texts, add_special_tokens=False)]
+
+
+def _split_by_tokens(text: str, max_tokens: int) -> List[str]:
+    """
+    Hard-splits a single over-long text into windows of at most `max_tokens`,
+    cutting on token boundaries (mapped back to the text via offsets).
+    """
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        step = max_tokens * 4
+        return [text[i : i + step] for i in range(0, len(text), step)]
+    offsets = tokenizer.encode(text, add_special_tokens=False).offsets
+    pieces = []
+    for start in range(0, len(offsets), max_tokens):
+        window = offsets[start : start + max_tokens]
+        pieces.append(text[window[0][0] : window[-1][1]])
+    return pieces
+
+
+def _heading_level(line: str):
+    """
+    Returns (level, title) if the line looks like a heading, else None.
+    """
+    if len(line) > 100:
+        return None
+    match = _MARKDOWN_HEADING.match(line)
+    if match:
+        return len(match.group(1)), match.group(2)
+    match = _NUMBERED_HEADING.match(line)
+    if match:
+        depth = match.group(1).count(".") + 1
+        # "2. Install the package" is a list item; "2. Related Work" a heading.
+        title_case = all(w[0].isupper() for w in match.group(2).split() if len(w) > 3)
+        if depth > 1 or title_case:
+            return depth, line
+    if len(line) <= 60 and line.isupper() and sum(c.isalpha() for c in line) >= 3:
+        return 1, line
+    return None
+
+
+def _is_table_line(line: str) -> bool:
+    return line.count("|") >= 2 or line.count("\t") >= 2
+
+
+def _document_pages(document) -> List[tuple]:
+    """
+    Returns (page_number, text) pairs for a loaded document. Uses the loader's
+    0-based "page" metadata when present, otherwise form feeds as page breaks.
+    """
+    page = document.metadata.get("page")
+    if page is not None:
+        return [(int(page) + 1, document.page_content)]
+    return [(i + 1, text) for i, text in enumerate(document.page_content.split("\f"))]
+
+
+def parse_blocks(documents) -> List[Block]:
+    """
+    Splits loaded documents into heading / paragraph / table blocks, tracking
+    the current section path and page number for each block.
+    """
+    blocks: List[Block] = []
+    section_path: List[str] = []
+
+    for document in documents:
+        for page, text in _document_pages(document):
+            kind, lines = None, []
+
+            def flush():
+                if lines:
+                    blocks.append(
+                        Block(kind, "\n".join(lines), page, " > ".join(section_path))
+                    )
+                lines.clear()
+
+            for raw_line in text.split("\n"):
+                line = raw_line.strip()
+                if not line:
+                    flush()
+                    continue
+                if _is_table_line(raw_line):
+                    if kind != "table":
+                        flush()
+                    kind = "table"
+                    lines.append(raw_line.rstrip())
+                    continue
+                heading = _heading_level(line)
+                if heading:
+                    flush()
+                    level, title = heading
+                    del section_path[level - 1 :]
+                    section_path.append(title)
+                    blocks.append(
+                        Block("heading", line, page, " > ".join(section_path))
+                    )
+                    kind = None
+                    continue
+                if kind != "paragraph":
+                    flush()
+                kind = "paragraph"
+                lines.append(line)
+            flush()
+
+    for block, tokens in zip(blocks, count_tokens([b.text for b in blocks])):
+        block.tokens = tokens
+    return blocks
+
+
+def _split_oversized(block: Block, max_tokens: int) -> List[Block]:
+    """
+    Splits a block larger than `max_tokens`: tables by rows (repeating the
+    header row in every piece), paragraphs by sentences, and any single unit
+    that is still too big by tokens.
+    """
+    if block.kind == "table":
+        header, *units = block.text.split("\n")
+        prefix, joiner = [header], "\n"
+    else:
+        units = _SENTENCE_END.split(block.text)
+        prefix, joiner = [], " "
+    prefix_tokens = count_tokens(prefix)[0] if prefix else 0
+
+    pieces = []
+    current, current_tokens = list(prefix), prefix_tokens
+    for unit, tokens in zip(units, count_tokens(units)):
+        if current_tokens + tokens > max_tokens and len(current) > len(prefix):
+            pieces.append(joiner.join(current))
+            current, current_tokens = list(prefix), prefix_tokens
+        if current_tokens + tokens > max_tokens:
+            pieces.extend(_split_by_tokens(joiner.join(current + [unit]), max_tokens))
+            current, current_tokens = list(prefix), prefix_tokens
+            continue
+        current.append(unit)
+        current_tokens += tokens
+    if len(current) > len(prefix):
+        pieces.append(joiner.join(current))
+    if not pieces:
+        pieces = _split_by_tokens(block.text, max_tokens)
+
+    return [
+        Block(block.kind, text, block.page, block.section, tokens)
+        for text, tokens in zip(pieces, count_tokens(pieces))
+    ]
+
+
+def _fill(block: Block, room: int):
+    """
+    Splits a paragraph into (head, rest) where head is as many leading
+    sentences as fit in `room` tokens. Head is None if none fit, or if the
+    block isn't a paragraph.
+    """
+    if block.kind != "paragraph" or room < CHUNK_MIN_FILL_TOKENS:
+        return None, block
+    sentences = _SENTENCE_END.split(block.text)
+    taken, used = 0, 0
+    for tokens in count_tokens(sentences):
+        if used + tokens + (1 if taken else 0) > room:
+            break
+        used += tokens + (1 if taken else 0)
+        taken += 1
+    if not taken or taken == len(sentences):
+        return None, block
+    head, rest = " ".join(sentences[:taken]), " ".join(sentences[taken:])
+    head_tokens, rest_tokens = count_tokens([head, rest])
+    return (
+        Block(block.kind, head, block.page, block.section, head_tokens),
+        Block(block.kind, rest, block.page, block.section, rest_tokens),
+    )
+
+
+def split_documents(
+    documents,
+    max_tokens: int = CHUNK_MAX_TOKENS,
+    min_tokens: int = CHUNK_MIN_TOKENS,
+):
+    """
+    Splits loaded LangChain documents into chunks of at most `max_tokens`
+    embedding-model tokens. Blocks are packed greedily; a heading starts a new
+    chunk unless the current one is still smaller than `min_tokens`. Each chunk
+    gets `page`, `page_end`, `section`, `chunk_index` and `token_count`
+    metadata on top of the first document's own metadata.
+    """
+    from langchain_core.documents import Document
+
+    if not documents:
+        return []
+    base_metadata = {
+        key: value
+        for key, value in documents[0].metadata.items()
+        if key not in ("page", "page_label")
+    }
+
+    chunks = []
+    current: List[Block] = []
+    current_tokens = 0
+
+    def emit():
+        if not current:
+            return
+        pages = [b.page for b in current if b.page is not None]
+        metadata = dict(base_metadata)
+        metadata.update(
+            section=current[0].section,
+            chunk_index=len(chunks),
+            token_count=current_tokens,
+        )
+        # Vector store metadata can't hold nulls, so pages are only set if known.
+        if pages:
+            metadata.update(page=pages[0], page_end=pages[-1])
+        text = "\n\n".join(b.text for b in current)
+        chunks.append(Document(page_content=text, metadata=metadata))
+
+    for block in parse_blocks(documents):
+        pieces = (
+            _split_oversized(block, max_tokens)
+            if block.tokens > max_tokens
+            else [block]
+        )
+        for piece in pieces:
+            starts_section = piece.kind == "heading" and current_tokens >= min_tokens
+            # +1 approximates the separator between blocks.
+            overflows = current_tokens + piece.tokens + 1 > max_tokens
+            if current and overflows and not starts_section:
+                # Fill the rest of the chunk with the paragraph's leading
+                # sentences rather than leaving the room unused.
+                head, piece = _fill(piece, max_tokens - current_tokens - 1)
+                if head:
+                    current.append(head)
+                    current_tokens += head.tokens + 1
+            if current and (starts_section or overflows):
+                emit()
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece.tokens + (1 if len(current) > 1 else 0)
+    emit()
+    return chunks
+
+
+def build_summaries(
+    chunks, file_id: str, filename: str, max_tokens: int = CHUNK_MAX_TOKENS
+):
+    """
+    Builds the routing vectors for two-stage retrieval: one extractive summary
+    per section (its heading path plus the lead of its text) and one for the
+    whole document (filename, section outline and opening text). Also tags
+    every chunk with `level` and its `section_id`. Returns the summary docs.
+    """
+    from langchain_core.documents import Document
+
+    sections = []
+    for chunk in chunks:
+        if not sections or sections[-1]["section"] != chunk.metadata["section"]:
+            sections.append({"section": chunk.metadata["section"], "chunks": []})
+        sections[-1]["chunks"].append(chunk)
+
+    summaries = []
+    for index, section in enumerate(sections):
+        section_id = f"{file_id}:s{index}"
+        for chunk in section["chunks"]:
+            chunk.metadata["level"] = LEVEL_CHUNK
+            chunk.metadata["section_id"] = section_id
+        first = section["chunks"][0].metadata
+        lead = _split_by_tokens(
+            "\n\n".join(c.page_content for c in section["chunks"][:2]), max_tokens
+        )[0]
+        metadata = {
+            "level": LEVEL_SECTION,
+            "section_id": section_id,
+            "section": section["section"],
+            "file_id": file_id,
+            "filename": filename,
+            "chunk_count": len(section["chunks"]),
+        }
+        if "page" in first:
+            metadata["page"] = first["page"]
+        text = f"{section['section']}\n{lead}".strip()
+        summaries.append(Document(page_content=text, metadata=metadata))
+
+    outline = "; ".join(s["section"] for s in sections if s["section"])
+    overview = (
+        f"{filename}\n{outline}\n{chunks[0].page_content}" if chunks else filename
+    )
+    summaries.append(
+        Document(
+            page_content=_split_by_tokens(overview, max_tokens)[0],
+            metadata={
+                "level": LEVEL_DOCUMENT,
+                "file_id": file_id,
+                "filename": filename,
+                "section_count": len(sections),
+            },
+        )
+    )
+    return summaries
+
+
+def compare_splitters(
+    documents, qa_pairs: Optional[list] = None, k: int = 10, lexical: bool = False
+) -> dict:
+    """
+    Compares this splitter against the previous RecursiveCharacterTextSplitter
+    (1000 chars, 100 overlap): vector count, estimated index and docstore
+    sizes (as ingestion stores them: the vector index holds only the vector
+    and its filter fields, the text goes to the docstore) and, when
+    `qa_pairs` ([{"question": ..., "answer": ...}]) is given, recall@k, i.e.
+    the share of questions whose answer text appears in a top-k chunk.
+    Chunks are ranked with the embedding model, or with BM25 when `lexical`
+    is set or the model can't be reached.
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    from backend.ingestion import VECTOR_METADATA_KEYS
+
+    legacy = RecursiveCharacterTextSplitter(
+        chunk_size=1000, chunk_overlap=100, length_function=len
+    ).split_documents(documents)
+    structured = split_documents(documents)
+    candidates = {"recursive_character": legacy, "structure_token": structured}
+    for chunk in legacy:
+        chunk.metadata.update(file_id="0", level=LEVEL_CHUNK)
+    for chunk in structured:
+        chunk.metadata["file_id"] = "0"
+    routing = {
+        "recursive_character": 0,
+        "structure_token": len(build_summaries(structured, "0", "document")),
+    }
+
+    report = {
+        "token_counts": "tokenizer" if _get_tokenizer() is not None else "estimated"
+    }
+    rank = None
+    if qa_pairs:
+        rank, report["recall_ranking"] = _get_ranker(lexical)
+    for name, chunks in candidates.items():
+        tokens = count_tokens([c.page_content for c in chunks])
+        # 384 float32 dims plus the filter fields per chunk vector.
+        index_bytes = sum(
+            384 * 4
+            + len(
+                json.dumps(
+                    {k: c.metadata[k] for k in VECTOR_METADATA_KEYS if k in c.metadata}
+                )
+            )
+            for c in chunks
+        )
+        docstore_bytes = sum(
+            len(zlib.compress(c.page_content.encode())) + len(json.dumps(c.metadata))
+            for c in chunks
+        )
+        report[name] = {
+            "vector_count": len(chunks),
+            "routing_vector_count": routing[name],
+            "avg_tokens": round(sum(tokens) / max(len(tokens), 1), 1),
+            "truncated_chunks": sum(1 for t in tokens if t > 254),
+            "estimated_index_bytes": index_bytes,
+            "estimated_docstore_bytes": docstore_bytes,
+        }
+        if rank:
+            report[name]["recall_at_k"] = _recall_at_k(chunks, qa_pairs, k, rank)
+    return report
+
+
+def _get_ranker(lexical: bool):
+    """
+    Returns (rank, name): `rank(texts, questions)` gives, per question, the
+    text indices best first.
+    """
+    if not lexical:
+        try:
+            from backend.ingestion import _get_embeddings_model
+
+            embeddings = _get_embeddings_model()
+            embeddings.embed_query("warm-up")
+            return _rank_by_embeddings(embeddings), "embeddings"
+        except Exception as e:
+            print(f"Warning: embedding model unavailable ({e}); ranking with BM25.")
+    return _rank_bm25, "bm25"
+
+
+def _rank_by_embeddings(embeddings):
+    def rank(texts, questions):
+        text_vectors = embeddings.embed_documents(texts)
+        rankings = []
+        for question in questions:
+            query_vector = embeddings.embed_query(question)
+            rankings.append(
+                sorted(
+                    range(len(texts)),
+                    key=lambda i: -sum(
+                        a * b for a, b in zip(query_vector, text_vectors[i])
+                    ),
+                )
+            )
+        return rankings
+
+    return rank
+
+
+def _rank_bm25(texts, questions, k1: float = 1.5, b: float = 0.75):
+    tokenize = lambda text: re.findall(r"\w+", text.lower())
+    docs = [Counter(tokenize(text)) for text in texts]
+    lengths = [sum(doc.values()) for doc in docs]
+    avg_length = sum(lengths) / max(len(lengths), 1)
+    doc_freq = Counter(term for doc in docs for term in doc)
+    rankings = []
+    for question in questions:
+        terms = set(tokenize(question))
+        scores = []
+        for doc, length in zip(docs, lengths):
+            score = 0.0
+            for term in terms & doc.keys():
+                idf = math.log(1 + (len(docs) - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+                tf = doc[term]
+                score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+            scores.append(score)
+        rankings.append(sorted(range(len(texts)), key=lambda i: -scores[i]))
+    return rankings
+
+
+def _recall_at_k(chunks, qa_pairs: list, k: int, rank) -> float:
+    # Line breaks differ between splitters, so compare on collapsed whitespace.
+    normalize = lambda text: " ".join(text.lower().split())
+    texts = [normalize(c.page_content) for c in chunks]
+    rankings = rank([c.page_content for c in chunks], [p["question"] for p in qa_pairs])
+    hits = 0
+    for pair, ranked in zip(qa_pairs, rankings):
+        answer = normalize(pair["answer"])
+        if any(answer in texts[i] for i in ranked[:k]):
+            hits += 1
+    return round(hits / len(qa_pairs), 3)
+
+
+def main():
+    from backend.ingestion import get_document_loader
+
+    parser = argparse.ArgumentParser(description="Compare document splitters.")
+    parser.add_argument("command", choices=["report"])
+    parser.add_argument("path")
+    parser.add_argument("--qa", help="JSONL file of {question, answer} pairs")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument(
+        "--lexical", action="store_true", help="rank with BM25 instead of embeddings"
+    )
+    args = parser.parse_args()
+
+    documents = get_document_loader(args.path, args.path).load()
+    qa_pairs = None
+    if args.qa:
+        with open(args.qa) as f:
+            qa_pairs = [json.loads(line) for line in f if line.strip()]
+    print(json.dumps(compare_splitters(documents, qa_pairs, args.k, args.lexical), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import os
+import json
+import zlib
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+import sqlalchemy
+from dotenv import load_dotenv
+
+from backend.db import docstore_table, get_sync_database_url
+
+load_dotenv()
+
+# Defaults to the shared application database (table `docstore_chunks`,
+# created by the Alembic migrations), so every worker and host sees every
+# file's chunks. A `sqlite:///...` URL keeps a single host's docstore in a
+# local file instead; its table is created on first use.
+DOCSTORE_URL = os.getenv("DOCSTORE_URL") or get_sync_database_url()
+
+# Keeps IN (...) lists and multi-row inserts within driver parameter limits.
+_BATCH = 500
+
+
+class DocStore:
+    """
+    Store of chunk text keyed by vector ID. Text is zlib-compressed and kept
+    out of the vector index, so vector queries only return IDs and scores;
+    callers hydrate the few chunks they actually use.
+
+    Blocking (a synchronous SQLAlchemy engine with its own small pool);
+    call it from a worker thread.
+    """
+
+    def __init__(self, url: str = DOCSTORE_URL):
+        self.engine = sqlalchemy.create_engine(url, pool_pre_ping=True)
+        if self.engine.dialect.name == "sqlite":
+            sqlalchemy.event.listen(self.engine, "connect", _sqlite_pragmas)
+            docstore_table.create(self.engine, checkfirst=True)
+
+    def put_many(self, file_id: str, entries: Iterable[Tuple[str, str, dict]]):
+        """
+        Stores (id, text, metadata) entries for a file, replacing existing IDs.
+        """
+        rows = [
+            {
+                "id": chunk_id,
+                "file_id": file_id,
+                "token_count": int(metadata.get("token_count", 0)),
+                "text": zlib.compress(text.encode("utf-8")),
+                "metadata": json.dumps(metadata),
+            }
+            for chunk_id, text, metadata in entries
+        ]
+        with self.engine.begin() as conn:
+            for start in range(0, len(rows), _BATCH):
+                batch = rows[start : start + _BATCH]
+                conn.execute(
+                    docstore_table.delete().where(
+                        docstore_table.c.id.in_([row["id"] for row in batch])
+                    )
+                )
+                conn.execute(docstore_table.insert(), batch)
+
+    def _select(self, columns: list, ids: List[str]) -> list:
+        rows = []
+        with self.engine.connect() as conn:
+            for start in range(0, len(ids), _BATCH):
+                query = sqlalchemy.select(docstore_table.c.id, *columns).where(
+                    docstore_table.c.id.in_(ids[start : start + _BATCH])
+                )
+                rows.extend(conn.execute(query))
+        return rows
+
+    def get_token_counts(self, ids: List[str]) -> Dict[str, int]:
+        """
+        Returns token counts without reading (or decompressing) any text.
+        """
+        return {
+            chunk_id: count
+            for chunk_id, count in self._select([docstore_table.c.token_count], ids)
+        }
+
+    def get_many(self, ids: List[str]) -> Dict[str, Tuple[str, dict]]:
+        """
+        Returns {id: (text, metadata)} for the IDs that exist.
+        """
+        columns = [docstore_table.c.text, docstore_table.c.metadata]
+        return {
+            chunk_id: (zlib.decompress(text).decode("utf-8"), json.loads(metadata))
+            for chunk_id, text, metadata in self._select(columns, ids)
+        }
+
+    def delete_file(self, file_id: str):
+        with self.engine.begin() as conn:
+            conn.execute(
+                docstore_table.delete().where(docstore_table.c.file_id == file_id)
+            )
+
+
+def _sqlite_pragmas(dbapi_connection, _):
+    # WAL so readers don't block the ingestion writer.
+    dbapi_connection.execute("PRAGMA journal_mode=WAL")
+    dbapi_connection.execute("PRAGMA synchronous=NORMAL")
+
+
+_docstore = None
+_docstore_lock = threading.Lock()
+
+
+def get_docstore() -> DocStore:
+    """
+    Returns the process-wide DocStore, creating it on first use.
+    """
+    global _docstore
+    with _docstore_lock:
+        if _docstore is None:
+            _docstore = DocStore()
+        return _docstore
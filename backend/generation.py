@@ -0,0 +1,365 @@
+import os
+import queue
+import codecs
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+GENERATION_PROVIDER = os.getenv("GENERATION_PROVIDER", "hf")
+GENERATION_MODEL = os.getenv(
+    "GENERATION_MODEL", "meta-llama/Meta-Llama-3.1-8B-Instruct"
+)
+GENERATION_MAX_TOKENS = int(os.getenv("GENERATION_MAX_TOKENS", "550"))
+GENERATION_STOP = [
+    s for s in os.getenv("GENERATION_STOP", "<|eot_id|>").split(",") if s
+]
+
+# Providers and models a request may pick with its `generation` overrides
+# (comma-separated). The defaults above are always allowed. Every distinct
+# model gets its own client, circuit breaker and metrics entry, so the set
+# must stay bounded.
+GENERATION_ALLOWED_PROVIDERS = {GENERATION_PROVIDER} | {
+    p.strip()
+    for p in os.getenv("GENERATION_ALLOWED_PROVIDERS", "").split(",")
+    if p.strip()
+}
+GENERATION_ALLOWED_MODELS = {GENERATION_MODEL} | {
+    m.strip()
+    for m in os.getenv("GENERATION_ALLOWED_MODELS", "").split(",")
+    if m.strip()
+}
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "http://localhost:8080/v1")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "not-needed")
+
+LLAMA_CPP_MODEL_PATH = os.getenv("LLAMA_CPP_MODEL_PATH")
+LLAMA_CPP_N_CTX = int(os.getenv("LLAMA_CPP_N_CTX", "4096"))
+LLAMA_CPP_N_THREADS = int(os.getenv("LLAMA_CPP_N_THREADS", "0")) or None
+LLAMA_CPP_SLOTS = int(os.getenv("LLAMA_CPP_SLOTS", "2"))
+# Number of system-prompt prefixes whose KV state is kept per slot.
+LLAMA_CPP_PREFIX_CACHE_SIZE = int(os.getenv("LLAMA_CPP_PREFIX_CACHE_SIZE", "4"))
+
+
+@dataclass
+class GenerationConfig:
+    """
+    Per-request generation settings. Defaults come from the environment.
+    """
+
+    provider: str = GENERATION_PROVIDER
+    model: str = GENERATION_MODEL
+    max_tokens: int = GENERATION_MAX_TOKENS
+    stop: List[str] = field(default_factory=lambda: list(GENERATION_STOP))
+    temperature: Optional[float] = None
+
+    def with_overrides(self, **overrides) -> "GenerationConfig":
+        return replace(self, **{k: v for k, v in overrides.items() if v is not None})
+
+
+class GenerationProvider:
+    """
+    Interface for chat generation backends. `messages` are OpenAI-style
+    {"role": ..., "content": ...} dicts; the first one is the (fixed) system
+    prompt, so providers that can cache it should.
+    """
+
+    def stream(self, messages: List[dict], config: GenerationConfig) -> Iterator[str]:
+        raise NotImplementedError
+
+    def complete(self, messages: List[dict], config: GenerationConfig) -> str:
+        return "".join(self.stream(messages, config))
+
+    def warm_up(self, system_prompt: Optional[str] = None):
+        """
+        Creates clients / loads models ahead of the first request.
+        """
+
+
+class HFInferenceProvider(GenerationProvider):
+    """
+    Hugging Face Inference API (the original backend).
+    """
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _client(model: str):
+        from huggingface_hub import InferenceClient
+
+        return InferenceClient(model=model, token=os.getenv("HUGGINGFACEHUB_API_TOKEN"))
+
+    def stream(self, messages, config):
+        stream = self._client(config.model).chat_completion(
+            messages=messages,
+            max_tokens=config.max_tokens,
+            stop=config.stop,
+            temperature=config.temperature,
+            stream=True,
+        )
+        for token in stream:
+            if token.choices and token.choices[0].delta.content:
+                yield token.choices[0].delta.content
+
+    def warm_up(self, system_prompt=None):
+        self._client(GENERATION_MODEL)
+
+
+class OpenAICompatibleProvider(GenerationProvider):
+    """
+    Any OpenAI-compatible chat server (llama.cpp server, vLLM, Ollama, ...).
+    `cache_prompt` asks llama.cpp-style servers to reuse the KV cache for the
+    shared prompt prefix; servers that don't know the field ignore it. Run
+    llama.cpp's server with `--cont-batching` for continuous batching.
+    """
+
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def _client():
+        from openai import OpenAI
+
+        return OpenAI(base_url=OPENAI_BASE_URL, api_key=OPENAI_API_KEY)
+
+    def stream(self, messages, config):
+        stream = self._client().chat.completions.create(
+            model=config.model,
+            messages=messages,
+            max_tokens=config.max_tokens,
+            stop=config.stop or None,
+            temperature=config.temperature,
+            stream=True,
+            extra_body={"cache_prompt": True},
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    def warm_up(self, system_prompt=None):
+        self._client()
+
+
+_END_OF_STREAM = object()
+
+
+@dataclass
+class _LlamaRequest:
+    messages: List[dict]
+    config: GenerationConfig
+    output: "queue.Queue" = field(default_factory=queue.Queue)
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+
+class _LlamaSlot:
+    """
+    One llama.cpp context plus the KV-cache snapshots of recently used
+    system-prompt prefixes. Model weights are memory-mapped, so slots share
+    them; each slot only adds its own KV cache.
+    """
+
+    def __init__(self, model_path: str):
+        from llama_cpp import Llama
+        from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+
+        self.llm = Llama(
+            model_path=model_path,
+            n_ctx=LLAMA_CPP_N_CTX,
+            n_threads=LLAMA_CPP_N_THREADS,
+            use_mmap=True,
+            verbose=False,
+        )
+        detokenize = lambda token: self.llm.detokenize([token]).decode(
+            "utf-8", errors="ignore"
+        )
+        self.formatter = Jinja2ChatFormatter(
+            template=self.llm.metadata["tokenizer.chat_template"],
+            eos_token=detokenize(self.llm.token_eos()),
+            bos_token=detokenize(self.llm.token_bos()),
+        )
+        self.prefix_states: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _tokenize(self, messages: List[dict]) -> List[int]:
+        prompt = self.formatter(messages=messages).prompt
+        return self.llm.tokenize(prompt.encode("utf-8"), add_bos=False, special=True)
+
+    def prime_prefix(self, system_prompt: str, tokens: List[int]) -> int:
+        """
+        Makes sure the KV cache holds the system-prompt prefix of `tokens`,
+        restoring a saved snapshot or evaluating and snapshotting it once.
+        Returns the prefix length in tokens.
+        """
+        key = hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()
+        cached = self.prefix_states.get(key)
+        if cached is not None:
+            self.prefix_states.move_to_end(key)
+            prefix_tokens, state = cached
+            current = self.llm.input_ids[: self.llm.n_tokens]
+            if list(current[: len(prefix_tokens)]) != prefix_tokens:
+                self.llm.load_state(state)
+            return len(prefix_tokens)
+
+        # The system-only rendering isn't always a token-prefix of the full
+        # prompt, so snapshot at the longest common token prefix.
+        system_tokens = self._tokenize([{"role": "system", "content": system_prompt}])
+        length = 0
+        for a, b in zip(system_tokens, tokens):
+            if a != b:
+                break
+            length += 1
+        prefix_tokens = tokens[:length]
+        self.llm.reset()
+        self.llm.eval(prefix_tokens)
+        self.prefix_states[key] = (prefix_tokens, self.llm.save_state())
+        while len(self.prefix_states) > LLAMA_CPP_PREFIX_CACHE_SIZE:
+            self.prefix_states.popitem(last=False)
+        return length
+
+    def run(self, request: _LlamaRequest):
+        tokens = self._tokenize(request.messages)
+        if request.messages and request.messages[0]["role"] == "system":
+            self.prime_prefix(request.messages[0]["content"], tokens)
+
+        config = request.config
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        holdback = max((len(s) for s in config.stop), default=1) - 1
+        pending = ""
+        # `generate` only evaluates the tokens after the longest prefix it
+        # already has in the KV cache, i.e. after the primed system prompt.
+        for count, token in enumerate(
+            self.llm.generate(tokens, temp=config.temperature or 0.0, reset=True)
+        ):
+            if request.cancelled.is_set() or token == self.llm.token_eos():
+                break
+            pending += decoder.decode(self.llm.detokenize([token]))
+            stop_at = min(
+                (pending.find(s) for s in config.stop if s in pending), default=-1
+            )
+            if stop_at >= 0:
+                pending = pending[:stop_at]
+                break
+            if len(pending) > holdback:
+                request.output.put(pending[: len(pending) - holdback])
+                pending = pending[len(pending) - holdback :]
+            if count + 1 >= config.max_tokens:
+                break
+        if pending:
+            request.output.put(pending)
+
+
+class LlamaCppProvider(GenerationProvider):
+    """
+    In-process llama.cpp engine for small quantized (GGUF) models on CPU.
+
+    A pool of `LLAMA_CPP_SLOTS` contexts serves a shared request queue: a new
+    request starts as soon as any slot finishes, instead of waiting for a
+    whole batch. Each slot keeps KV-cache snapshots of the system-prompt
+    prefix, so the fixed system prompt is evaluated once per slot, not once
+    per request. `config.model` is ignored; the model is LLAMA_CPP_MODEL_PATH.
+    """
+
+    def __init__(self, model_path: Optional[str] = LLAMA_CPP_MODEL_PATH):
+        if not model_path:
+            raise ValueError("LLAMA_CPP_MODEL_PATH is not set. Check your .env file.")
+        self._model_path = model_path
+        self._requests: "queue.Queue[_LlamaRequest]" = queue.Queue()
+        self._slots: List[_LlamaSlot] = []
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self, system_prompt: Optional[str] = None):
+        """
+        Loads the slots (priming `system_prompt` in each, if given) and starts
+        one worker thread per slot. Slots are only touched by their worker
+        once it is running.
+        """
+        with self._start_lock:
+            if self._slots:
+                return
+            for i in range(LLAMA_CPP_SLOTS):
+                slot = _LlamaSlot(self._model_path)
+                if system_prompt:
+                    messages = [
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": ""},
+                    ]
+                    slot.prime_prefix(system_prompt, slot._tokenize(messages))
+                self._slots.append(slot)
+                threading.Thread(
+                    target=self._worker,
+                    args=(slot,),
+                    name=f"llama-slot-{i}",
+                    daemon=True,
+                ).start()
+
+    def _worker(self, slot: _LlamaSlot):
+        while True:
+            request = self._requests.get()
+            try:
+                if not request.cancelled.is_set():
+                    slot.run(request)
+            except Exception as e:
+                request.output.put(e)
+            finally:
+                request.output.put(_END_OF_STREAM)
+
+    def stream(self, messages, config):
+        self._ensure_started()
+        request = _LlamaRequest(messages=messages, config=config)
+        self._requests.put(request)
+        try:
+            while True:
+                item = request.output.get()
+                if item is _END_OF_STREAM:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            request.cancelled.set()
+
+    def warm_up(self, system_prompt=None):
+        self._ensure_started(system_prompt)
+
+
+_PROVIDERS = {
+    "hf": HFInferenceProvider,
+    "openai": OpenAICompatibleProvider,
+    "llamacpp": LlamaCppProvider,
+}
+
+_instances: Dict[str, GenerationProvider] = {}
+_instances_lock = threading.Lock()
+
+
+def get_provider(name: str = GENERATION_PROVIDER) -> GenerationProvider:
+    """
+    Returns the (shared) provider instance registered under `name`.
+    """
+    if name not in _PROVIDERS:
+        raise ValueError(
+            f"Unknown generation provider '{name}'. Choose one of: {', '.join(_PROVIDERS)}"
+        )
+    with _instances_lock:
+        if name not in _instances:
+            _instances[name] = _PROVIDERS[name]()
+        return _instances[name]
+
+
+def check_allowed(config: GenerationConfig):
+    """
+    Raises ValueError unless the config's provider and model are on the
+    GENERATION_ALLOWED_* lists.
+    """
+    if config.provider not in GENERATION_ALLOWED_PROVIDERS:
+        raise ValueError(
+            f"Generation provider '{config.provider}' is not allowed. "
+            f"Choose one of: {', '.join(sorted(GENERATION_ALLOWED_PROVIDERS))}"
+        )
+    if config.model not in GENERATION_ALLOWED_MODELS:
+        raise ValueError(
+            f"Generation model '{config.model}' is not allowed. "
+            f"Choose one of: {', '.join(sorted(GENERATION_ALLOWED_MODELS))}"
+        )
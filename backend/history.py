@@ -0,0 +1,185 @@
+import os
+import re
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Optional, Tuple
+
+from dotenv import load_dotenv
+
+from backend.cache import Cache, get_cache
+
+load_dotenv()
+
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "3"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "600"))
+HISTORY_SUMMARY_TOKEN_BUDGET = int(os.getenv("HISTORY_SUMMARY_TOKEN_BUDGET", "200"))
+# Idle sessions expire from the (shared) cache after this many seconds.
+HISTORY_TTL_S = int(os.getenv("HISTORY_TTL_S", str(24 * 3600)))
+
+# Answers are stored clipped; the full text already lives in the client's state.
+ANSWER_STORE_CHARS = 600
+
+_FOLLOW_UP_PATTERN = re.compile(
+    r"^\s*(and|also|so|then|what about|how about)\b"
+    r"|\b(it|its|this|that|these|those|they|them|their|he|she|his|her|"
+    r"above|previous|earlier|same|former|latter)\b",
+    re.IGNORECASE,
+)
+
+
+def _estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate (~4 characters per token) used for budgeting.
+    """
+    return (len(text) + 3) // 4
+
+
+def _compact(text: str, limit: int) -> str:
+    """
+    Collapses whitespace and Markdown decoration and clips the text to `limit` chars.
+    """
+    text = re.sub(r"[#*`>]+", "", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    if len(text) > limit:
+        text = text[:limit].rsplit(" ", 1)[0] + "..."
+    return text
+
+
+def _first_sentence(text: str) -> str:
+    match = re.search(r"^(.+?[.!?])(\s|$)", text)
+    return match.group(1) if match else text
+
+
+@dataclass
+class SessionHistory:
+    """
+    Compact per-session history: a rolling summary of older turns plus the
+    most recent turns verbatim (clipped).
+    """
+
+    summary: str = ""
+    turns: Deque[Tuple[str, str]] = field(default_factory=deque)
+
+    def token_count(self) -> int:
+        return _estimate_tokens(self.summary) + sum(
+            _estimate_tokens(q) + _estimate_tokens(a) for q, a in self.turns
+        )
+
+    def add_turn(self, question: str, answer: str):
+        self.turns.append(
+            (
+                _compact(question, ANSWER_STORE_CHARS),
+                _compact(answer, ANSWER_STORE_CHARS),
+            )
+        )
+        while self.turns and (
+            len(self.turns) > HISTORY_MAX_TURNS
+            or self.token_count() > HISTORY_TOKEN_BUDGET
+        ):
+            self._fold_oldest_turn()
+
+    def _fold_oldest_turn(self):
+        """
+        Moves the oldest verbatim turn into the rolling summary, then trims the
+        summary from the front so it stays within its own token budget.
+        """
+        question, answer = self.turns.popleft()
+        line = f"- Q: {_compact(question, 160)} A: {_compact(_first_sentence(answer), 200)}"
+        lines = [l for l in self.summary.split("\n") if l] + [line]
+        while len(lines) > 1 and (
+            _estimate_tokens("\n".join(lines)) > HISTORY_SUMMARY_TOKEN_BUDGET
+        ):
+            lines.pop(0)
+        self.summary = "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        return {"summary": self.summary, "turns": [list(t) for t in self.turns]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SessionHistory":
+        return cls(
+            summary=data.get("summary", ""),
+            turns=deque(tuple(t) for t in data.get("turns", [])),
+        )
+
+    def render(self) -> str:
+        parts = []
+        if self.summary:
+            parts.append(f"Earlier in the conversation:\n{self.summary}")
+        for question, answer in self.turns:
+            parts.append(f"User: {question}\nAssistant: {answer}")
+        return "\n\n".join(parts)
+
+
+class HistoryStore:
+    """
+    `SessionHistory` objects keyed by session id, kept in the shared cache so
+    any worker can serve a session's follow-up questions.
+    """
+
+    def __init__(self, cache: Optional[Cache] = None, ttl_s: int = HISTORY_TTL_S):
+        self._cache = cache
+        self._ttl_s = ttl_s
+
+    @property
+    def cache(self) -> Cache:
+        return self._cache or get_cache()
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"history:{session_id}"
+
+    def get(self, session_id: str) -> Optional[SessionHistory]:
+        data = self.cache.get(self._key(session_id))
+        return SessionHistory.from_dict(data) if data else None
+
+    def add_turn(self, session_id: str, question: str, answer: str):
+        # A session sends one question at a time, so read-modify-write is
+        # safe even when consecutive turns land on different workers.
+        history = self.get(session_id) or SessionHistory()
+        history.add_turn(question, answer)
+        self.cache.set(self._key(session_id), history.to_dict(), ttl_s=self._ttl_s)
+
+    def clear(self, session_id: str):
+        self.cache.delete(self._key(session_id))
+
+
+history_store = HistoryStore()
+
+
+def get_history_text(session_id: Optional[str]) -> str:
+    """
+    Returns the rendered (bounded) history block for a session, or "" if none.
+    """
+    if not session_id:
+        return ""
+    try:
+        history = history_store.get(session_id)
+    except Exception as e:
+        print(f"Error reading history for session {session_id}: {e}")
+        return ""
+    return history.render() if history else ""
+
+
+def record_turn(session_id: Optional[str], question: str, answer: str):
+    """
+    Appends a finished question/answer turn to the session's history.
+    """
+    if not session_id or not answer.strip():
+        return
+    try:
+        history_store.add_turn(session_id, question, answer)
+    except Exception as e:
+        print(f"Error recording history for session {session_id}: {e}")
+
+
+def needs_rewrite(question: str, history_text: str) -> bool:
+    """
+    Decides whether a question is a follow-up that must be rewritten into a
+    standalone search query. Standalone questions skip the extra LLM call.
+    """
+    if not history_text:
+        return False
+    if len(question.split()) <= 3:
+        return True
+    return bool(_FOLLOW_UP_PATTERN.search(question))
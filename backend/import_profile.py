@@ -0,0 +1,90 @@
+"""
+Import-time profile for the backend.
+
+Runs `python -X importtime -c "import backend.main"` in a fresh interpreter
+and reports the slowest imports. Exits non-zero when the total import time
+exceeds the budget or when a module that must stay lazy was imported, so it
+can be used as a regression check:
+
+    python -m backend.import_profile --budget-ms 800 --top 15
+"""
+
+import argparse
+import subprocess
+import sys
+
+# Modules that must only be imported on first use (see backend/ingestion.py
+# and backend/retreival.py), never as a side effect of importing the app.
+LAZY_MODULES = (
+    "langchain",
+    "langchain_community",
+    "langchain_pinecone",
+    "langchain_huggingface",
+    "langchain_text_splitters",
+    "pinecone",
+    "huggingface_hub",
+)
+
+
+def profile_imports(target: str = "backend.main") -> list:
+    """
+    Returns a list of (module, self_us, cumulative_us) tuples for every module
+    imported while importing `target`.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {target}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        errors = "\n".join(
+            line
+            for line in result.stderr.splitlines()
+            if not line.startswith("import time:")
+        )
+        raise RuntimeError(f"Importing {target} failed:\n{errors}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", default="backend.main")
+    parser.add_argument("--budget-ms", type=float, default=1000.0)
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    rows = profile_imports(args.target)
+    total_ms = sum(self_us for _, self_us, _ in rows) / 1000
+    top_level = {name.split(".")[0] for name, _, _ in rows}
+    eager = sorted(m for m in LAZY_MODULES if m in top_level)
+
+    print(f"Import of {args.target}: {total_ms:.1f} ms across {len(rows)} modules")
+    print(f"\nTop {args.top} imports by cumulative time:")
+    for name, _, cumulative_us in sorted(rows, key=lambda r: r[2], reverse=True)[
+        : args.top
+    ]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if total_ms > args.budget_ms:
+        print(
+            f"\nFAIL: import time {total_ms:.1f} ms exceeds budget {args.budget_ms} ms"
+        )
+        failed = True
+    if eager:
+        print(f"\nFAIL: modules imported eagerly: {', '.join(eager)}")
+        failed = True
+    if not failed:
+        print("\nOK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,104 @@
 import os
-import tempfile
-from pinecone import Pinecone, ServerlessSpec
-from langchain_pinecone import PineconeVectorStore
-
-from langchain_huggingface import HuggingFaceEndpointEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
+import asyncio
+import importlib
+from functools import lru_cache
 from dotenv import load_dotenv
 from pathlib import Path
 
+from backend.chunking import (
+    warm_up as chunking_warm_up,
+    split_documents,
+    build_summaries,
+    LEVEL_CHUNK,
+    LEVEL_SECTION,
+)
+from backend.docstore import get_docstore
+from backend.resilience import get_upstream, EMBEDDING_TIMEOUT_S, VECTOR_TIMEOUT_S
+
 load_dotenv()
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 HUGGINGFACEHUB_API_TOKEN = os.getenv("HUGGINGFACEHUB_API_TOKEN")
 
+EMBED_BATCH_SIZE = 32
+UPSERT_BATCH_SIZE = 100
+
+# Only these fields are stored with each vector (for filtering); chunk text
+# and the rest of its metadata live in the shared docstore.
+VECTOR_METADATA_KEYS = ("file_id", "level", "section_id")
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 
-def _get_embeddings_model() -> HuggingFaceEndpointEmbeddings:
+# Heavy client libraries (pinecone, langchain_*) are imported inside the
+# functions that need them, so importing this module stays cheap. Loaders are
+# resolved the first time their file type is seen.
+_LOADERS = {
+    ".pdf": ("langchain_community.document_loaders.pdf", "PyPDFLoader"),
+    ".txt": ("langchain_community.document_loaders.text", "TextLoader"),
+    ".docx": ("langchain_community.document_loaders.word_document", "Docx2txtLoader"),
+}
+
+
+@lru_cache(maxsize=1)
+def _get_embeddings_model():
     """
-    Lazily initializes and returns the HuggingFace embeddings client.
+    Lazily initializes and returns the (cached) HuggingFace embeddings client.
     This function is called *after* load_dotenv() has run.
     """
     if not HUGGINGFACEHUB_API_TOKEN:
         raise ValueError("HUGGINGFACEHUB_API_TOKEN is not set. Check your .env file.")
 
-    return HuggingFaceEndpointEmbeddings(model="sentence-transformers/all-MiniLM-L6-v2")
+    from langchain_huggingface import HuggingFaceEndpointEmbeddings
+
+    return HuggingFaceEndpointEmbeddings(model=EMBEDDING_MODEL)
 
 
-def _get_pinecone_client() -> Pinecone:
+@lru_cache(maxsize=1)
+def _get_local_embeddings_model():
     """
-    Lazily initializes and returns the Pinecone client.
-    This function is called *after* load_dotenv() has run.
+    Loads (once) the same embedding model in-process, used as the fallback
+    when the remote embeddings endpoint is slow or down. Vectors are
+    interchangeable with the remote ones.
+    """
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    print("Loading local embedding model as a fallback.")
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+
+
+def embed_query(text: str) -> list:
+    """
+    Embeds a search query under a deadline, hedging slow calls and falling
+    back to the local model.
+    """
+    return get_upstream("embeddings", EMBEDDING_TIMEOUT_S, hedge=True).call(
+        lambda: _get_embeddings_model().embed_query(text),
+        fallback=lambda: _get_local_embeddings_model().embed_query(text),
+    )
+
+
+def embed_documents(texts: list) -> list:
+    """
+    Embeds a batch of texts for ingestion; not hedged, since batches are
+    large and their latency varies with size.
+    """
+    return get_upstream("embeddings.batch", EMBEDDING_TIMEOUT_S * 3).call(
+        lambda: _get_embeddings_model().embed_documents(texts),
+        fallback=lambda: _get_local_embeddings_model().embed_documents(texts),
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_pinecone_client():
+    """
+    Lazily initializes and returns the (cached) Pinecone client, creating the
+    index on first use. This function is called *after* load_dotenv() has run.
     """
     if not PINECONE_API_KEY:
         raise ValueError("PINECONE_API_KEY is not set. Check your .env file.")
 
+    from pinecone import Pinecone, ServerlessSpec
+
     pc = Pinecone(api_key=PINECONE_API_KEY)
 
     if PINECONE_INDEX_NAME not in pc.list_indexes().names():
@@ -47,103 +112,155 @@ def _get_pinecone_client() -> Pinecone:
     return pc
 
 
-def _get_vectorstore() -> PineconeVectorStore:
+@lru_cache(maxsize=1)
+def _get_index():
     """
-    Initializes the PineconeVectorStore using the lazy client.
+    Returns the (cached) Pinecone index handle using the lazy client.
     """
-    pc = _get_pinecone_client()
-    index = pc.Index(PINECONE_INDEX_NAME)
+    return _get_pinecone_client().Index(PINECONE_INDEX_NAME)
 
-    embeddings = _get_embeddings_model()
 
-    vectorstore = PineconeVectorStore(
-        index=index,
-        embedding=embeddings,
-        text_key="text",
-    )
-    return vectorstore
+def vector_id(doc) -> str:
+    """
+    Deterministic vector ID for a chunk / section / document vector. Section
+    and document IDs encode what routing needs, so queries can skip metadata.
+    """
+    level = doc.metadata["level"]
+    if level == LEVEL_CHUNK:
+        return f"{doc.metadata['file_id']}:c{doc.metadata['chunk_index']}"
+    if level == LEVEL_SECTION:
+        return doc.metadata["section_id"]
+    return f"{doc.metadata['file_id']}:d"
+
+
+@lru_cache(maxsize=None)
+def _get_loader_class(ext: str):
+    """Imports the loader class for a file extension on first use."""
+    if ext not in _LOADERS:
+        raise ValueError(f"Unsupported file type: {ext}")
+    module_name, class_name = _LOADERS[ext]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def is_supported_file(filename: str) -> bool:
+    """Whether a document loader exists for the file's extension."""
+    return os.path.splitext(filename)[1].lower() in _LOADERS
 
 
 def get_document_loader(filename: str, file_path: str):
     """Selects the appropriate document loader based on the file extension."""
     ext = os.path.splitext(filename)[1].lower()
-    if ext == ".pdf":
-        return PyPDFLoader(file_path)
-    elif ext == ".txt":
-        return TextLoader(file_path)
-    elif ext == ".docx":
-        return Docx2txtLoader(file_path)
-    else:
-        raise ValueError(f"Unsupported file type: {ext}")
+    return _get_loader_class(ext)(file_path)
 
 
-async def ingest_document(file_content: bytes, file_id: str, filename: str):
+def warm_up():
     """
-    Loads (from bytes), splits, and ingests a document's vectors into Pinecone.
+    Loads the chunking tokenizer, pre-creates the Pinecone client, index
+    handle, embeddings client and docstore, and issues a tiny embed call so
+    the first real request doesn't pay for it. Blocking; run it off the
+    event loop.
     """
-    print(f"Starting ingestion for file_id: {file_id}, filename: {filename}")
-    tmp_file_path = None
+    chunking_warm_up()
+    _get_index()
+    get_docstore()
+    _get_embeddings_model().embed_query("warm-up")
 
-    try:
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=f"_{filename}"
-        ) as tmp_file:
-            tmp_file.write(file_content)
-            tmp_file_path = tmp_file.name
 
-        print(f"File content written to temporary file: {tmp_file_path}")
+async def _upsert_vectors(docs: list):
+    """
+    Embeds docs in batches and upserts them with filter-only metadata.
+    """
+    index = _get_index()
+    writes = get_upstream("pinecone.write", VECTOR_TIMEOUT_S * 4)
+    vectors = []
+    for start in range(0, len(docs), EMBED_BATCH_SIZE):
+        batch = docs[start : start + EMBED_BATCH_SIZE]
+        values = await asyncio.to_thread(
+            embed_documents, [d.page_content for d in batch]
+        )
+        for doc, embedding in zip(batch, values):
+            metadata = {
+                k: doc.metadata[k] for k in VECTOR_METADATA_KEYS if k in doc.metadata
+            }
+            vectors.append((vector_id(doc), embedding, metadata))
+
+    for start in range(0, len(vectors), UPSERT_BATCH_SIZE):
+        await asyncio.to_thread(
+            writes.call,
+            index.upsert,
+            vectors=vectors[start : start + UPSERT_BATCH_SIZE],
+        )
+
 
-        loader = get_document_loader(filename, tmp_file_path)
-        documents = loader.load()
+async def ingest_document(file_path: str, file_id: str, filename: str) -> dict:
+    """
+    Loads (from a stored file), splits, and ingests a document's vectors into
+    Pinecone. Returns the page and chunk counts, which are recorded as file
+    metadata.
+    """
+    print(f"Starting ingestion for file_id: {file_id}, filename: {filename}")
+
+    try:
+        loader = get_document_loader(filename, file_path)
+        documents = await asyncio.to_thread(loader.load)
 
         if not documents:
             print("No documents loaded, skipping text splitting.")
-            return
+            return {"page_count": 0, "chunk_count": 0}
 
         print(f"Loaded {len(documents)} document(s) from file.")
 
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=100,
-            length_function=len,
-        )
-        chunks = text_splitter.split_documents(documents)
+        chunks = split_documents(documents)
         print(f"Split document into {len(chunks)} chunks.")
 
         if not chunks:
             print("No chunks to ingest.")
-            return
+            return {"page_count": len(documents), "chunk_count": 0}
 
         for chunk in chunks:
             chunk.metadata["file_id"] = file_id
             chunk.metadata["filename"] = filename
+            # The loader records the storage path; it means nothing to readers.
+            chunk.metadata.pop("source", None)
+
+        summaries = build_summaries(chunks, file_id=file_id, filename=filename)
+        print(
+            f"Added metadata (file_id: {file_id}) to all chunks and built "
+            f"{len(summaries)} section/document summaries."
+        )
 
-        print(f"Added metadata (file_id: {file_id}) to all chunks.")
+        docstore = get_docstore()
+        await asyncio.to_thread(
+            docstore.put_many,
+            file_id,
+            [(vector_id(c), c.page_content, c.metadata) for c in chunks],
+        )
+        print(f"Stored {len(chunks)} chunk texts in the docstore.")
 
-        vectorstore = _get_vectorstore()
-        await vectorstore.aadd_documents(chunks)
+        await _upsert_vectors(chunks + summaries)
 
         print(
             f"Successfully ingested {len(chunks)} chunks into Pinecone for file_id: {file_id}"
         )
+        return {"page_count": len(documents), "chunk_count": len(chunks)}
 
     except Exception as e:
         print(f"Error during ingestion: {e}")
         raise
-    finally:
-        if tmp_file_path and os.path.exists(tmp_file_path):
-            os.remove(tmp_file_path)
-            print(f"Cleaned up temporary file: {tmp_file_path}")
 
 
 async def delete_vectors(file_id: str):
     """
-    Deletes all vectors associated with a specific file_id from Pinecone.
+    Deletes all vectors associated with a specific file_id from Pinecone,
+    and the file's chunk texts from the docstore.
     """
     print(f"Attempting to delete vectors for file_id: {file_id}")
     try:
-        vectorstore = _get_vectorstore()
-        await vectorstore.adelete(filter={"file_id": file_id})
+        writes = get_upstream("pinecone.write", VECTOR_TIMEOUT_S * 4)
+        await asyncio.to_thread(
+            writes.call, _get_index().delete, filter={"file_id": file_id}
+        )
+        await asyncio.to_thread(get_docstore().delete_file, file_id)
         print(f"Successfully deleted vectors for file_id: {file_id}")
     except Exception as e:
         print(f"Error deleting vectors: {e}")
@@ -0,0 +1,74 @@
+"""
+Closed-loop load test against a running backend, for comparing throughput
+across worker counts:
+
+    uvicorn backend.main:app --port 9000 --workers 1   # then 2, 4, ...
+    python -m backend.load_test --url http://localhost:9000 --concurrency 64
+
+By default it hits `GET /files` (a metadata query, no remote calls). Pass
+`--path /process-query --query "..."` to include retrieval and generation.
+Multiple workers need a shared CACHE_URL and PostgreSQL; see the README.
+"""
+
+import time
+import asyncio
+import argparse
+
+import httpx
+
+
+async def _client_loop(client, method, path, body, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            response = await client.request(method, path, json=body)
+            await response.aread()
+            if response.status_code >= 400:
+                errors[response.status_code] = errors.get(response.status_code, 0) + 1
+                continue
+        except httpx.HTTPError as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            continue
+        latencies.append(time.monotonic() - started)
+
+
+async def run(url: str, path: str, concurrency: int, duration: float, query=None) -> dict:
+    method, body = ("POST", {"query": query}) if query else ("GET", None)
+    latencies, errors = [], {}
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60.0) as client:
+        deadline = time.monotonic() + duration
+        await asyncio.gather(
+            *(
+                _client_loop(client, method, path, body, deadline, latencies, errors)
+                for _ in range(concurrency)
+            )
+        )
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+        "p99_ms": (
+            round(latencies[int(0.99 * (len(latencies) - 1))] * 1000, 1)
+            if latencies
+            else None
+        ),
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backend throughput load test.")
+    parser.add_argument("--url", default="http://localhost:9000")
+    parser.add_argument("--path", default="/files")
+    parser.add_argument("--query", help="POST this query instead of a GET")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15.0)
+    args = parser.parse_args()
+
+    print(asyncio.run(run(args.url, args.path, args.concurrency, args.duration, args.query)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,503 @@
+"""
+Deadlines, hedged requests and circuit breakers for the remote calls made
+by ingestion and retrieval (embeddings, Pinecone and the LLM providers).
+
+Each remote dependency is an `Upstream`. `Upstream.call` runs a blocking
+call on a shared worker pool with a deadline; for idempotent reads it sends
+one duplicate ("hedge") once the call is slower than the upstream's recent
+p95 latency and returns whichever finishes first. `Upstream.stream` puts
+first-token, idle and total deadlines on a streaming call. Repeated
+failures open the upstream's circuit breaker, so later calls fail fast (and
+go straight to their fallback) until a trial call succeeds.
+
+To see hedging and the breaker against fake upstreams with injected latency:
+
+    python -m backend.resilience simulate --calls 200 --slow-rate 0.03
+
+The same fakes back the tests in tests/test_resilience.py.
+"""
+
+import os
+import time
+import queue
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, Optional
+
+from dotenv import load_dotenv
+
+from backend.cache import Cache, get_cache
+
+load_dotenv()
+
+EMBEDDING_TIMEOUT_S = float(os.getenv("EMBEDDING_TIMEOUT_S", "10"))
+VECTOR_TIMEOUT_S = float(os.getenv("VECTOR_TIMEOUT_S", "5"))
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "20"))
+LLM_FIRST_TOKEN_TIMEOUT_S = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT_S", "30"))
+LLM_IDLE_TIMEOUT_S = float(os.getenv("LLM_IDLE_TIMEOUT_S", "20"))
+LLM_TOTAL_TIMEOUT_S = float(os.getenv("LLM_TOTAL_TIMEOUT_S", "180"))
+
+# A hedge is sent once a call has taken longer than this quantile of the
+# upstream's recent latencies (and never sooner than HEDGE_MIN_DELAY_S).
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_DELAY_S = float(os.getenv("HEDGE_MIN_DELAY_S", "0.05"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+LATENCY_WINDOW = 200
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_S = float(os.getenv("BREAKER_RESET_S", "30"))
+
+# Smaller model (same provider) to answer with when the main one is degraded.
+FALLBACK_MODEL = os.getenv("FALLBACK_MODEL")
+
+ANSWER_CACHE_TTL_S = int(os.getenv("ANSWER_CACHE_TTL_S", str(6 * 3600)))
+
+# Threads abandoned by a timed-out or losing call keep running until the
+# remote call returns, so the pool is sized well above normal concurrency.
+RESILIENCE_MAX_WORKERS = int(os.getenv("RESILIENCE_MAX_WORKERS", "32"))
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=RESILIENCE_MAX_WORKERS, thread_name_prefix="upstream"
+            )
+        return _executor
+
+
+class UpstreamError(Exception):
+    """
+    Base class for failures raised by the resilience layer itself.
+    """
+
+    def __init__(self, upstream: str, message: str):
+        super().__init__(f"{upstream}: {message}")
+        self.upstream = upstream
+
+
+class UpstreamTimeout(UpstreamError):
+    pass
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. Once `reset_s` has passed
+    a single trial call is let through (half-open); its outcome closes or
+    re-opens the circuit. If a trial never reports an outcome (e.g. its
+    stream was abandoned), another one is let through after `reset_s`.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self,
+        threshold: int = BREAKER_FAILURE_THRESHOLD,
+        reset_s: float = BREAKER_RESET_S,
+    ):
+        self.threshold = threshold
+        self.reset_s = reset_s
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state != self.CLOSED and now - self._opened_at >= self.reset_s:
+                # While half-open, _opened_at is when the current trial started.
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.threshold:
+                if self.state != self.OPEN:
+                    print(f"Circuit opened after {self._failures} failures.")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+_END_OF_STREAM = object()
+
+
+class Upstream:
+    """
+    One remote dependency: its deadline, recent latencies, circuit breaker
+    and counters. Only enable `hedge` for idempotent calls.
+    """
+
+    def __init__(self, name: str, timeout_s: float, hedge: bool = False):
+        self.name = name
+        self.timeout_s = timeout_s
+        self.hedge = hedge
+        self.breaker = CircuitBreaker()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._counters = dict.fromkeys(
+            (
+                "calls",
+                "hedges",
+                "hedge_wins",
+                "timeouts",
+                "failures",
+                "short_circuits",
+                "fallbacks",
+            ),
+            0,
+        )
+        self._lock = threading.Lock()
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _record_latency(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def _quantile(self, q: float) -> Optional[float]:
+        with self._lock:
+            if not self._latencies:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Seconds to wait before hedging, or None until enough latencies have
+        been seen to know what "slow" means for this upstream.
+        """
+        if not self.hedge or len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY_S, self._quantile(HEDGE_QUANTILE))
+
+    def _admit(self):
+        if not self.breaker.allow():
+            self._count("short_circuits")
+            raise CircuitOpen(self.name, "circuit open, upstream is degraded")
+        self._count("calls")
+
+    def call(
+        self,
+        fn: Callable,
+        *args,
+        fallback: Optional[Callable] = None,
+        timeout_s: Optional[float] = None,
+        **kwargs,
+    ):
+        """
+        Runs `fn(*args, **kwargs)` under the upstream's deadline (or
+        `timeout_s`), hedging if enabled. On any failure `fallback()` is
+        returned instead, when given.
+        """
+        try:
+            return self._call(fn, args, kwargs, timeout_s or self.timeout_s)
+        except Exception as e:
+            if fallback is None:
+                raise
+            print(f"[{self.name}] {e}; using fallback.")
+            self._count("fallbacks")
+            return fallback()
+
+    def _call(self, fn, args, kwargs, timeout_s: float):
+        self._admit()
+        executor = _get_executor()
+        started = time.monotonic()
+        deadline = started + timeout_s
+        delay = self.hedge_delay()
+        pending = {executor.submit(fn, *args, **kwargs): ("primary", started)}
+        hedged = False
+        error = None
+
+        while pending:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            wait_for = deadline - now
+            if delay is not None and not hedged:
+                wait_for = min(wait_for, max(0.0, started + delay - now))
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            if not done:
+                if delay is not None and not hedged:
+                    hedged = True
+                    self._count("hedges")
+                    future = executor.submit(fn, *args, **kwargs)
+                    pending[future] = ("hedge", time.monotonic())
+                continue
+            for future in done:
+                role, submitted = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                self._record_latency(time.monotonic() - submitted)
+                self.breaker.record_success()
+                if role == "hedge":
+                    self._count("hedge_wins")
+                for other in pending:
+                    other.cancel()
+                return result
+
+        self.breaker.record_failure()
+        for other in pending:
+            other.cancel()
+        if not pending and error is not None:
+            self._count("failures")
+            raise error
+        self._count("timeouts")
+        raise UpstreamTimeout(self.name, f"no response within {timeout_s:.1f}s")
+
+    def stream(
+        self,
+        make_stream: Callable[[], Iterator],
+        first_token_timeout_s: float = LLM_FIRST_TOKEN_TIMEOUT_S,
+        idle_timeout_s: float = LLM_IDLE_TIMEOUT_S,
+        total_timeout_s: float = LLM_TOTAL_TIMEOUT_S,
+    ) -> Iterator:
+        """
+        Iterates `make_stream()` on a background thread and re-yields its
+        items, raising UpstreamTimeout if the first item, the next item or
+        the whole stream takes too long. Streams are never hedged.
+        """
+        self._admit()
+        output: "queue.Queue" = queue.Queue()
+        stop = threading.Event()
+
+        def pump():
+            stream = None
+            try:
+                stream = make_stream()
+                for item in stream:
+                    if stop.is_set():
+                        break
+                    output.put(item)
+            except Exception as e:
+                output.put(e)
+            finally:
+                close = getattr(stream, "close", None)
+                if close is not None:
+                    close()
+                output.put(_END_OF_STREAM)
+
+        started = time.monotonic()
+        threading.Thread(target=pump, name=f"{self.name}-stream", daemon=True).start()
+        first = True
+        settled = False
+        try:
+            while True:
+                wait_for = first_token_timeout_s if first else idle_timeout_s
+                wait_for = min(wait_for, started + total_timeout_s - time.monotonic())
+                try:
+                    item = output.get(timeout=max(wait_for, 0.0))
+                except queue.Empty:
+                    settled = True
+                    self.breaker.record_failure()
+                    self._count("timeouts")
+                    raise UpstreamTimeout(
+                        self.name,
+                        "no response" if first else "stopped responding mid-answer",
+                    )
+                if item is _END_OF_STREAM:
+                    settled = True
+                    self.breaker.record_success()
+                    return
+                if isinstance(item, Exception):
+                    settled = True
+                    self.breaker.record_failure()
+                    self._count("failures")
+                    raise item
+                if first:
+                    self._record_latency(time.monotonic() - started)
+                    first = False
+                yield item
+        finally:
+            stop.set()
+            # The consumer stopped early (client disconnect, generator closed
+            # or collected). A stream that produced output counts as healthy;
+            # one abandoned before its first item says nothing about the
+            # upstream, and the breaker re-trials after reset_s if needed.
+            if not settled and not first:
+                self.breaker.record_success()
+
+    def metrics(self) -> dict:
+        p95 = self._quantile(0.95)
+        with self._lock:
+            counters = dict(self._counters)
+        counters["hedge_win_rate"] = (
+            round(counters["hedge_wins"] / counters["hedges"], 3)
+            if counters["hedges"]
+            else None
+        )
+        counters["p95_ms"] = round(p95 * 1000, 1) if p95 is not None else None
+        counters["circuit"] = self.breaker.state
+        return counters
+
+
+_upstreams: Dict[str, Upstream] = {}
+_upstreams_lock = threading.Lock()
+
+
+def get_upstream(name: str, timeout_s: float, hedge: bool = False) -> Upstream:
+    """
+    Returns the shared Upstream registered under `name`, creating it on first use.
+    """
+    with _upstreams_lock:
+        if name not in _upstreams:
+            _upstreams[name] = Upstream(name, timeout_s=timeout_s, hedge=hedge)
+        return _upstreams[name]
+
+
+def upstream_metrics() -> dict:
+    with _upstreams_lock:
+        upstreams = list(_upstreams.values())
+    return {u.name: u.metrics() for u in upstreams}
+
+
+class AnswerCache:
+    """
+    Recent answers keyed by (file_id, standalone question) in the shared
+    cache, served as a last-resort fallback when generation is unavailable.
+    """
+
+    def __init__(self, cache: Optional[Cache] = None, ttl_s: int = ANSWER_CACHE_TTL_S):
+        self._cache = cache
+        self._ttl_s = ttl_s
+
+    @property
+    def cache(self) -> Cache:
+        return self._cache or get_cache()
+
+    @staticmethod
+    def _key(file_id, question: str) -> str:
+        normalized = " ".join(question.lower().split())
+        digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        return f"answer:{file_id or ''}:{digest}"
+
+    def get(self, file_id, question: str) -> Optional[str]:
+        try:
+            return self.cache.get(self._key(file_id, question))
+        except Exception as e:
+            print(f"Error reading answer cache: {e}")
+            return None
+
+    def put(self, file_id, question: str, answer: str):
+        try:
+            self.cache.set(self._key(file_id, question), answer, ttl_s=self._ttl_s)
+        except Exception as e:
+            print(f"Error writing answer cache: {e}")
+
+
+answer_cache = AnswerCache()
+
+
+def fake_remote(
+    base_ms: float,
+    slow_rate: float = 0.0,
+    slow_ms: float = 0.0,
+    seed: int = 0,
+    schedule_ms: Optional[list] = None,
+    error: Optional[Exception] = None,
+) -> Callable:
+    """
+    Returns a stand-in for a remote call that sleeps `base_ms` plus jitter,
+    or `slow_ms` for a `slow_rate` fraction of calls, then returns "ok" (or
+    raises `error`). Latencies in `schedule_ms` are used first, in call
+    order, which makes individual calls deliberately slow or fast.
+    """
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    schedule = deque(schedule_ms or ())
+
+    def remote():
+        with rng_lock:
+            if schedule:
+                latency_ms = schedule.popleft()
+            elif rng.random() < slow_rate:
+                latency_ms = slow_ms
+            else:
+                latency_ms = base_ms + rng.uniform(0, base_ms * 0.2)
+        time.sleep(latency_ms / 1000)
+        if error is not None:
+            raise error
+        return "ok"
+
+    return remote
+
+
+def simulate(calls: int, base_ms: float, slow_rate: float, slow_ms: float, seed: int = 0):
+    """
+    Drives a hedged Upstream against a fake remote call whose latency is
+    `base_ms` plus jitter, and `slow_ms` for a `slow_rate` fraction of calls.
+    """
+    results = {}
+    for hedge in (False, True):
+        upstream = Upstream(f"fake-{'hedged' if hedge else 'plain'}", 5.0, hedge=hedge)
+        remote = fake_remote(base_ms, slow_rate, slow_ms, seed)
+        latencies = []
+        for _ in range(calls):
+            started = time.monotonic()
+            upstream.call(remote)
+            latencies.append(time.monotonic() - started)
+        latencies.sort()
+        results[upstream.name] = {
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+            "p99_ms": round(latencies[int(0.99 * (len(latencies) - 1))] * 1000, 1),
+            **{
+                k: v
+                for k, v in upstream.metrics().items()
+                if k in ("hedges", "hedge_wins")
+            },
+        }
+
+    failing = fake_remote(0, error=ConnectionError("fake outage"))
+    breaker_upstream = Upstream("fake-outage", 1.0)
+    for _ in range(BREAKER_FAILURE_THRESHOLD * 2):
+        breaker_upstream.call(failing, fallback=lambda: "fallback")
+    results[breaker_upstream.name] = breaker_upstream.metrics()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Hedging and circuit-breaker simulation against fake upstreams."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sim = subparsers.add_parser("simulate")
+    sim.add_argument("--calls", type=int, default=200)
+    sim.add_argument("--base-ms", type=float, default=20)
+    sim.add_argument("--slow-rate", type=float, default=0.03)
+    sim.add_argument("--slow-ms", type=float, default=500)
+    args = parser.parse_args()
+
+    for name, report in simulate(
+        args.calls, args.base_ms, args.slow_rate, args.slow_ms
+    ).items():
+        print(name, report)
+
+
+if __name__ == "__main__":
+    main()
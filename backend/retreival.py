@@ -1,41 +1,94 @@
 import os
+from functools import lru_cache
+from operator import itemgetter
 from typing import Dict, Optional, List
 from dotenv import load_dotenv
 
-from huggingface_hub import InferenceClient
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
-from langchain.prompts import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
+from backend.ingestion import _get_index, embed_query
+from backend.docstore import get_docstore
+from backend.resilience import (
+    get_upstream,
+    answer_cache,
+    UpstreamTimeout,
+    CircuitOpen,
+    VECTOR_TIMEOUT_S,
+    LLM_TIMEOUT_S,
+    LLM_TOTAL_TIMEOUT_S,
+    FALLBACK_MODEL,
 )
-from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
-
-
-from backend.ingestion import _get_vectorstore
-from langchain_core.documents import Document
+from backend.history import get_history_text, record_turn, needs_rewrite
+from backend.generation import GenerationConfig, get_provider
+from backend.chunking import LEVEL_DOCUMENT, LEVEL_SECTION, LEVEL_CHUNK
 from pathlib import Path
 
 load_dotenv()
 
+# Chunks are sized to the embedding model's window and follow the document
+# structure, so a handful of them is enough context.
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "10"))
+# Two-stage retrieval fan-out: how many documents (when not filtering by
+# file_id; 0 skips this stage) and sections to route to before the chunk search.
+# Each stage is one query whatever its top_k, so the defaults are wide enough
+# to keep recall@10 at ~0.99 of a flat search (see backend/retrieval_benchmark.py).
+RETRIEVAL_DOC_FANOUT = int(os.getenv("RETRIEVAL_DOC_FANOUT", "40"))
+RETRIEVAL_SECTION_FANOUT = int(os.getenv("RETRIEVAL_SECTION_FANOUT", "64"))
+# Token budget for the assembled context; only chunks that fit are read from
+# the docstore.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2500"))
 
-client = InferenceClient(
-    model="meta-llama/Meta-Llama-3.1-8B-Instruct",
-    token=os.getenv("HUGGINGFACEHUB_API_TOKEN"),
-)
+SYSTEM_PROMPT = """You are a helpful assistant. Answer the user's question based on the provided context, and also from your own knowledge.
+If the answer is not found in the context, never say "I could not find an answer in the document."
+If answer is not found in the context, try to respond from your own knowledge.
+Keep your answers concise and to the point, and professional.
+Use the conversation history only to resolve follow-up questions.
+
+---
+**Formatting Instructions:**
+Format your final answer using clear and concise Markdown,try to keep the answer medium length.
+- Use headings (`##` or `###`) for main topics.
+- Use bold white (`**text**`) to emphasize key terms.
+- Use bullet points (`* item`) for lists or key points.
+- Use numbered lists (`1. item`) for steps or sequences.
+---"""
+
+# langchain is imported inside the functions below so that importing this
+# module (and backend.main) stays cheap.
 
 
-def _get_llm_chain():
+def _llm_upstream(config: GenerationConfig):
+    return get_upstream(f"llm:{config.provider}:{config.model}", LLM_TOTAL_TIMEOUT_S)
+
+
+def _describe_failure(e: Exception) -> str:
+    """
+    User-facing explanation of why an answer could not be generated.
+    """
+    if isinstance(e, CircuitOpen):
+        return "The language model is temporarily unavailable after repeated errors."
+    if isinstance(e, UpstreamTimeout):
+        return "The language model took too long to respond."
+    return "The language model returned an error."
+
+
+def _get_llm_chain(config: GenerationConfig):
     """
     Creates a custom LangChain runnable (a "Lambda") that
-    calls the Hugging Face InferenceClient and *streams* the response.
+    calls the configured generation provider and *streams* the response.
+    If the model fails before producing any output, FALLBACK_MODEL (when
+    set) is tried; otherwise the error propagates to the caller.
     """
+    from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+    from langchain_core.runnables import RunnableLambda
+
+    provider = get_provider(config.provider)
+    attempts = [config]
+    if FALLBACK_MODEL and FALLBACK_MODEL != config.model:
+        attempts.append(config.with_overrides(model=FALLBACK_MODEL))
 
     def stream_llm(prompt_value):
         """
         Takes the output from the prompt template (a ChatPromptValue),
-        formats it, and *yields* tokens from the InferenceClient.
+        formats it, and *yields* tokens from the provider.
         """
         messages = []
         for msg in prompt_value.to_messages():
@@ -46,76 +99,192 @@ def _get_llm_chain():
             elif isinstance(msg, AIMessage):
                 messages.append({"role": "assistant", "content": msg.content})
 
-        try:
-            stream = client.chat_completion(
-                messages=messages,
-                max_tokens=550,
-                stop=["<|eot_id|>"],
-                stream=True,
-            )
-
-            print("\n--- [DEBUG] Streaming response from LLM... ---")
-            for token in stream:
-                if token.choices and token.choices[0].delta.content:
-                    chunk = token.choices[0].delta.content
+        for i, attempt in enumerate(attempts):
+            started = False
+            try:
+                print(
+                    f"\n--- [DEBUG] Streaming response from "
+                    f"{attempt.provider}/{attempt.model}... ---"
+                )
+                for chunk in _llm_upstream(attempt).stream(
+                    lambda: provider.stream(messages, attempt)
+                ):
+                    started = True
                     yield chunk
-            print("\n--- [DEBUG] Stream finished. ---")
+                print("\n--- [DEBUG] Stream finished. ---")
+                return
 
-        except Exception as e:
-            print(f"\nError calling Hugging Face client: {e}")
-            yield "Sorry, I ran into an error trying to generate a response."
+            except Exception as e:
+                print(f"\nError calling generation provider '{attempt.provider}': {e}")
+                if started or i == len(attempts) - 1:
+                    raise
 
     return RunnableLambda(stream_llm)
 
 
-def _get_retrieval_chain(file_id: Optional[str] = None):
+@lru_cache(maxsize=1)
+def _get_prompt():
     """
-    Constructs a RAG chain using the custom InferenceClient runnable.
+    Builds (once) the chat prompt template used by the RAG chain. The system
+    message is fixed so providers can cache its KV state; everything that
+    varies per request goes in the user message.
     """
-    vectorstore = _get_vectorstore()
-
-    search_kwargs = {"k": 79}
-    if file_id:
-        print(f"Retrieval chain: Filtering by file_id: {file_id}")
-        search_kwargs["filter"] = {"file_id": str(file_id)}
-    else:
-        print("Retrieval chain: No file_id, searching all documents.")
-
-    retriever = vectorstore.as_retriever(
-        search_type="similarity", search_kwargs=search_kwargs
+    from langchain_core.prompts import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        HumanMessagePromptTemplate,
     )
 
-    system_template = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
-You are a helpful assistant. Answer the user's question based on the following context, and also from your own knowledge.
-If the answer is not found in the context, never say "I could not find an answer in the document."
-If answer is not found in the context, try to respond from your own knowledge.
-Keep your answers concise and to the point, and professional.
-
----
-**Formatting Instructions:**
-Format your final answer using clear and concise Markdown,try to keep the answer medium length.
-- Use headings (`##` or `###`) for main topics.
-- Use bold white (`**text**`) to emphasize key terms.
-- Use bullet points (`* item`) for lists or key points.
-- Use numbered lists (`1. item`) for steps or sequences.
----
+    human_template = """Context:
+{context}
 
-Context:
-{context}<|eot_id|>"""
+Conversation history:
+{history}
 
-    human_template = """<|start_header_id|>user<|end_header_id|>
 Question:
-{question}<|eot_id|><|start_header_id|>assistant<|end_header_id|>
-"""
+{question}"""
 
-    prompt = ChatPromptTemplate.from_messages(
+    return ChatPromptTemplate.from_messages(
         [
-            SystemMessagePromptTemplate.from_template(system_template),
+            SystemMessagePromptTemplate.from_template(SYSTEM_PROMPT),
             HumanMessagePromptTemplate.from_template(human_template),
         ]
     )
 
-    llm_chain = _get_llm_chain()
+
+def _hydrate(index, ids: List[str], token_budget: int = CONTEXT_TOKEN_BUDGET):
+    """
+    Turns ranked chunk IDs into Documents. Token counts are read first so
+    only chunks that fit the budget are decompressed; the best chunk is
+    always kept. IDs missing from the docstore (files ingested before it
+    existed, with text in the vector metadata) are fetched from the index.
+    """
+    from langchain_core.documents import Document
+
+    docstore = get_docstore()
+    counts = docstore.get_token_counts(ids)
+    selected, used = [], 0
+    for chunk_id in ids:
+        tokens = counts.get(chunk_id, 0)
+        if selected and used + tokens > token_budget:
+            continue
+        selected.append(chunk_id)
+        used += tokens
+
+    stored = docstore.get_many(selected)
+    missing = [chunk_id for chunk_id in selected if chunk_id not in stored]
+    if missing:
+        print(f"--- [DEBUG] {len(missing)} chunks not in docstore; fetching from index ---")
+        reads = get_upstream("pinecone.query", VECTOR_TIMEOUT_S, hedge=True)
+        for chunk_id, vector in reads.call(index.fetch, ids=missing).vectors.items():
+            metadata = dict(vector.metadata or {})
+            stored[chunk_id] = (metadata.pop("text", ""), metadata)
+
+    empty = [chunk_id for chunk_id in selected if not stored.get(chunk_id, ("",))[0]]
+    if empty:
+        # Vectors without text anywhere: the docstore row is gone or was
+        # never written (e.g. a docstore that isn't shared between hosts).
+        print(
+            f"--- [ERROR] {len(empty)} of {len(selected)} retrieved chunks have no "
+            f"text in the docstore or the index; skipping them: {empty[:5]} ---"
+        )
+    return [
+        Document(page_content=stored[chunk_id][0], metadata=stored[chunk_id][1])
+        for chunk_id in selected
+        if chunk_id not in empty
+    ]
+
+
+def route_chunk_ids(
+    search,
+    file_id: Optional[str] = None,
+    k: int = RETRIEVAL_K,
+    doc_fanout: int = RETRIEVAL_DOC_FANOUT,
+    section_fanout: int = RETRIEVAL_SECTION_FANOUT,
+) -> List[str]:
+    """
+    The routing half of `hierarchical_search`. `search(top_k, filter)` runs
+    one vector query for the (already embedded) question and returns match
+    IDs best first. Routes to the top documents (unless a file_id is given),
+    then the top sections, and returns the top-k chunk IDs inside those
+    sections. Falls back to a flat chunk search when no section vectors
+    match, e.g. for files ingested before section summaries existed.
+    """
+    scope = {"file_id": str(file_id)} if file_id else {}
+    if not file_id and doc_fanout > 0:
+        document_ids = search(doc_fanout, {"level": LEVEL_DOCUMENT})
+        if document_ids:
+            file_ids = sorted({d.rsplit(":", 1)[0] for d in document_ids})
+            scope = {"file_id": {"$in": file_ids}}
+            print(f"--- [DEBUG] Routed to documents: {file_ids} ---")
+
+    section_ids = search(section_fanout, {"level": LEVEL_SECTION, **scope})
+    if not section_ids:
+        print("--- [DEBUG] No section vectors matched; using flat chunk search ---")
+        flat_filter = {"file_id": str(file_id)} if file_id else None
+        return search(k, flat_filter)
+
+    print(f"--- [DEBUG] Routed to sections: {section_ids} ---")
+    return search(k, {"level": LEVEL_CHUNK, "section_id": {"$in": section_ids}})
+
+
+def hierarchical_search(
+    index,
+    query: str,
+    file_id: Optional[str] = None,
+    k: int = RETRIEVAL_K,
+    doc_fanout: int = RETRIEVAL_DOC_FANOUT,
+    section_fanout: int = RETRIEVAL_SECTION_FANOUT,
+):
+    """
+    Two-stage retrieval. The query is embedded once and routed to chunks by
+    `route_chunk_ids`. Vector queries return IDs and scores only; document
+    and section IDs encode the file and section, and chunk text is read from
+    the docstore.
+    """
+    embedding = embed_query(query)
+    reads = get_upstream("pinecone.query", VECTOR_TIMEOUT_S, hedge=True)
+
+    def search(top_k: int, metadata_filter: Optional[dict]) -> List[str]:
+        response = reads.call(
+            index.query,
+            vector=embedding,
+            top_k=top_k,
+            filter=metadata_filter,
+            include_metadata=False,
+        )
+        return [match.id for match in response.matches]
+
+    chunk_ids = route_chunk_ids(search, file_id, k, doc_fanout, section_fanout)
+    return _hydrate(index, chunk_ids)
+
+
+def _get_retrieval_chain(
+    file_id: Optional[str] = None, config: Optional[GenerationConfig] = None
+):
+    """
+    Constructs a RAG chain using the custom generation-provider runnable.
+    """
+    from langchain_core.runnables import RunnableLambda
+
+    if file_id:
+        print(f"Retrieval chain: Filtering by file_id: {file_id}")
+    else:
+        print("Retrieval chain: No file_id, searching all documents.")
+
+    def retrieve(query: str):
+        try:
+            return hierarchical_search(_get_index(), query, file_id=file_id)
+        except Exception as e:
+            # Degrade to answering without context rather than failing.
+            print(f"Retrieval failed, answering without context: {e}")
+            return []
+
+    retriever = RunnableLambda(retrieve)
+
+    prompt = _get_prompt()
+
+    llm_chain = _get_llm_chain(config or GenerationConfig())
 
     def format_docs(docs: list) -> str:
         return "\n\n".join(doc.page_content for doc in docs)
@@ -132,8 +301,12 @@ Question:
 
     rag_chain = (
         {
-            "context": retriever | RunnableLambda(log_retrieved_docs) | format_docs,
-            "question": RunnablePassthrough(),
+            "context": itemgetter("search_query")
+            | retriever
+            | RunnableLambda(log_retrieved_docs)
+            | format_docs,
+            "question": itemgetter("question"),
+            "history": itemgetter("history"),
         }
         | prompt
         | llm_chain
@@ -142,9 +315,108 @@ Question:
     return rag_chain
 
 
-def get_streaming_answer(query: str, file_id: Optional[str] = None):
+def warm_up():
+    """
+    Pre-creates the default generation provider (loading local models and
+    caching the system prompt where supported) and the prompt template, and
+    imports the langchain modules used per query. Blocking; run it off the
+    event loop.
+    """
+    get_provider().warm_up(SYSTEM_PROMPT)
+    _get_prompt()
+    _get_llm_chain(GenerationConfig())
+
+
+def _rewrite_query(question: str, history: str, config: GenerationConfig) -> str:
     """
-    Given a query and file_id, returns a *generator* that yields the RAG answer.
+    Rewrites a follow-up question into a standalone search query using the
+    conversation history. Falls back to the original question on any error.
     """
-    chain = _get_retrieval_chain(file_id=file_id)
-    return chain.stream(query)
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                "Rewrite the user's follow-up question as a single standalone "
+                "search query, using the conversation history to resolve "
+                "references. Reply with the query only."
+            ),
+        },
+        {
+            "role": "user",
+            "content": f"History:\n{history}\n\nFollow-up question: {question}",
+        },
+    ]
+    try:
+        rewrite_config = config.with_overrides(max_tokens=64, stop=config.stop + ["\n"])
+        rewritten = _llm_upstream(config).call(
+            get_provider(config.provider).complete,
+            messages,
+            rewrite_config,
+            timeout_s=LLM_TIMEOUT_S,
+        )
+        rewritten = rewritten.strip().strip('"')
+        if rewritten:
+            print(f"--- [DEBUG] Rewrote query: '{question}' -> '{rewritten}' ---")
+            return rewritten
+    except Exception as e:
+        print(f"Error rewriting query, using the original: {e}")
+    return question
+
+
+def get_streaming_answer(
+    query: str,
+    file_id: Optional[str] = None,
+    session_id: Optional[str] = None,
+    config: Optional[GenerationConfig] = None,
+):
+    """
+    Given a query, file_id, optional session_id and generation config, returns
+    a *generator* that yields the RAG answer. Follow-up questions are
+    rewritten against the session history before retrieval, and the finished
+    turn is recorded. If generation fails, an earlier answer to the same
+    standalone question is served when available, otherwise a specific
+    error message.
+    """
+    config = config or GenerationConfig()
+    chain = _get_retrieval_chain(file_id=file_id, config=config)
+
+    def generate():
+        history = get_history_text(session_id)
+        follow_up = needs_rewrite(query, history)
+        search_query = _rewrite_query(query, history, config) if follow_up else query
+        # Answers are cached under the standalone question, so another
+        # session's "what about section 2?" never hits them. A follow-up
+        # whose rewrite failed has no standalone form and isn't cached.
+        cacheable = not follow_up or search_query != query
+        answer_parts = []
+        try:
+            for chunk in chain.stream(
+                {
+                    "question": query,
+                    "search_query": search_query,
+                    "history": history or "(none)",
+                }
+            ):
+                answer_parts.append(chunk)
+                yield chunk
+        except Exception as e:
+            print(f"Error generating answer: {e}")
+            reason = _describe_failure(e)
+            if answer_parts:
+                yield f"\n\n_{reason} The answer above may be incomplete._"
+                record_turn(session_id, query, "".join(answer_parts))
+                return
+            cached = answer_cache.get(file_id, search_query) if cacheable else None
+            if cached:
+                yield f"_{reason} Showing an earlier answer to this question._\n\n"
+                yield cached
+                return
+            yield f"{reason} Please try again in a moment."
+            return
+
+        answer = "".join(answer_parts)
+        record_turn(session_id, query, answer)
+        if cacheable:
+            answer_cache.put(file_id, search_query, answer)
+
+    return generate()
@@ -0,0 +1,241 @@
+"""
+Benchmark of flat vs two-stage (document -> section -> chunk) retrieval on a
+synthetic, topic-clustered corpus held in memory:
+
+    python -m backend.retrieval_benchmark --docs 200 --sections 25 --chunks 20
+
+With the defaults the corpus has 100k chunk vectors. The two-stage search
+runs the real routing code (`route_chunk_ids` in backend/retreival.py)
+against an in-memory stand-in for the Pinecone index that scores vectors
+exactly and supports the same metadata filters. For each query it reports
+the number of vectors scored, latency, and recall@k of the two-stage search
+against the exact flat top-k. `--sweep` also tries a grid of fan-outs.
+"""
+
+import io
+import time
+import argparse
+import contextlib
+from types import SimpleNamespace
+
+import numpy as np
+
+from backend.chunking import LEVEL_CHUNK, LEVEL_DOCUMENT, LEVEL_SECTION
+from backend.retreival import (
+    route_chunk_ids,
+    RETRIEVAL_DOC_FANOUT,
+    RETRIEVAL_SECTION_FANOUT,
+)
+
+DIM = 384
+
+
+def _normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def build_corpus(docs: int, sections: int, chunks: int, seed: int = 0) -> dict:
+    """
+    Generates chunk vectors clustered by section within document, plus the
+    mean-vector section and document summaries used for routing.
+    """
+    rng = np.random.default_rng(seed)
+    doc_centers = rng.normal(size=(docs, 1, 1, DIM))
+    section_centers = doc_centers + 0.8 * rng.normal(size=(docs, sections, 1, DIM))
+    chunk_vectors = section_centers + 0.6 * rng.normal(
+        size=(docs, sections, chunks, DIM)
+    )
+    chunk_vectors = _normalize(chunk_vectors.astype(np.float32))
+    return {
+        "chunks": chunk_vectors.reshape(-1, DIM),
+        "sections": _normalize(chunk_vectors.mean(axis=2)).reshape(-1, DIM),
+        "documents": _normalize(chunk_vectors.mean(axis=(1, 2))),
+        "shape": (docs, sections, chunks),
+    }
+
+
+class InMemoryIndex:
+    """
+    Exact-scoring stand-in for the Pinecone index, laid out like ingestion
+    writes it: IDs "<file>:d", "<file>:s<n>" and "<file>:c<n>", with
+    `level`, `file_id` and `section_id` metadata. Supports equality and
+    `$in` filters, and counts the vectors it scores.
+    """
+
+    def __init__(self, corpus: dict):
+        docs, sections, chunks = corpus["shape"]
+        doc_of_chunk = np.repeat(np.arange(docs), sections * chunks)
+        section_of_chunk = np.repeat(np.arange(docs * sections), chunks)
+        doc_of_section = np.repeat(np.arange(docs), sections)
+
+        self.vectors = np.concatenate(
+            [corpus["documents"], corpus["sections"], corpus["chunks"]]
+        )
+        self.ids = (
+            [f"{d}:d" for d in range(docs)]
+            + [f"{d}:s{s % sections}" for s, d in enumerate(doc_of_section)]
+            + [f"{d}:c{c}" for c, d in enumerate(doc_of_chunk)]
+        )
+        no_section = np.full(docs, -1)
+        # Metadata values are encoded as ints; `_codes` maps them back.
+        self._fields = {
+            "level": np.concatenate(
+                [
+                    np.zeros(docs, int),
+                    np.ones(docs * sections, int),
+                    np.full(len(doc_of_chunk), 2),
+                ]
+            ),
+            "file_id": np.concatenate([np.arange(docs), doc_of_section, doc_of_chunk]),
+            "section_id": np.concatenate(
+                [no_section, np.arange(docs * sections), section_of_chunk]
+            ),
+        }
+        self._codes = {
+            "level": {LEVEL_DOCUMENT: 0, LEVEL_SECTION: 1, LEVEL_CHUNK: 2},
+            "file_id": {str(d): d for d in range(docs)},
+            "section_id": {self.ids[docs + s]: s for s in range(docs * sections)},
+        }
+        # Posting lists, so filtered queries only score matching vectors.
+        self._postings = {
+            field: {code: np.flatnonzero(values == code) for code in np.unique(values)}
+            for field, values in self._fields.items()
+        }
+        self.vectors_scored = 0
+
+    def _candidates(self, metadata_filter):
+        if not metadata_filter:
+            return np.arange(len(self.ids))
+        allowed = {}
+        for field, condition in metadata_filter.items():
+            values = condition["$in"] if isinstance(condition, dict) else [condition]
+            allowed[field] = [
+                self._codes[field][v] for v in values if v in self._codes[field]
+            ]
+        # Start from the most selective condition and check the others.
+        sizes = {
+            field: sum(len(self._postings[field].get(c, ())) for c in codes)
+            for field, codes in allowed.items()
+        }
+        first = min(sizes, key=sizes.get)
+        rows = np.concatenate(
+            [self._postings[first].get(c, np.empty(0, int)) for c in allowed[first]]
+            or [np.empty(0, int)]
+        )
+        for field, codes in allowed.items():
+            if field != first:
+                rows = rows[np.isin(self._fields[field][rows], codes)]
+        return rows
+
+    def query(self, vector, top_k, filter=None, include_metadata=False):
+        rows = self._candidates(filter)
+        self.vectors_scored += len(rows)
+        scores = self.vectors[rows] @ vector
+        k = min(top_k, len(rows))
+        if k == 0:
+            return SimpleNamespace(matches=[])
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return SimpleNamespace(
+            matches=[
+                SimpleNamespace(id=self.ids[rows[i]], score=float(scores[i]))
+                for i in best
+            ]
+        )
+
+
+def _searcher(index: InMemoryIndex, vector):
+    def search(top_k, metadata_filter):
+        return [
+            m.id for m in index.query(vector, top_k, filter=metadata_filter).matches
+        ]
+
+    return search
+
+
+def run(docs, sections, chunks, queries, k, fanouts, seed: int = 0) -> list:
+    """
+    Returns one result per (doc_fanout, section_fanout) pair in `fanouts`.
+    """
+    corpus = build_corpus(docs, sections, chunks, seed)
+    index = InMemoryIndex(corpus)
+    rng = np.random.default_rng(seed + 1)
+    targets = rng.integers(0, len(corpus["chunks"]), size=queries)
+    query_vectors = _normalize(
+        corpus["chunks"][targets]
+        + 0.5 * rng.normal(size=(queries, DIM)).astype(np.float32)
+    )
+
+    index.vectors_scored = 0
+    started = time.perf_counter()
+    exact = [set(_searcher(index, q)(k, {"level": LEVEL_CHUNK})) for q in query_vectors]
+    flat_ms = 1000 * (time.perf_counter() - started) / queries
+    flat_scored = index.vectors_scored // queries
+
+    results = []
+    for doc_fanout, section_fanout in fanouts:
+        index.vectors_scored = 0
+        started = time.perf_counter()
+        # route_chunk_ids logs its routing decisions; keep the report readable.
+        with contextlib.redirect_stdout(io.StringIO()):
+            routed = [
+                set(
+                    route_chunk_ids(
+                        _searcher(index, q),
+                        k=k,
+                        doc_fanout=doc_fanout,
+                        section_fanout=section_fanout,
+                    )
+                )
+                for q in query_vectors
+            ]
+        elapsed = time.perf_counter() - started
+        recall = np.mean([len(e & r) / len(e) for e, r in zip(exact, routed)])
+        results.append(
+            {
+                "corpus_chunks": len(corpus["chunks"]),
+                "doc_fanout": doc_fanout,
+                "section_fanout": section_fanout,
+                "flat_vectors_scored": flat_scored,
+                "two_stage_vectors_scored": index.vectors_scored // queries,
+                "flat_ms_per_query": round(flat_ms, 3),
+                "two_stage_ms_per_query": round(1000 * elapsed / queries, 3),
+                "two_stage_recall_at_k": round(float(recall), 3),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Flat vs two-stage retrieval benchmark."
+    )
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--sections", type=int, default=25)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--doc-fanout", type=int, default=RETRIEVAL_DOC_FANOUT)
+    parser.add_argument("--section-fanout", type=int, default=RETRIEVAL_SECTION_FANOUT)
+    parser.add_argument(
+        "--sweep", action="store_true", help="also try a grid of fan-outs"
+    )
+    args = parser.parse_args()
+
+    fanouts = [(args.doc_fanout, args.section_fanout)]
+    if args.sweep:
+        fanouts += [
+            (d, s)
+            for d in (3, 5, 10, 20)
+            for s in (8, 16, 32, 64)
+            if (d, s) != fanouts[0]
+        ]
+    for docs in sorted({max(args.docs // 10, 1), max(args.docs // 2, 1), args.docs}):
+        for report in run(
+            docs, args.sections, args.chunks, args.queries, args.k, fanouts
+        ):
+            print(report)
+
+
+if __name__ == "__main__":
+    main()
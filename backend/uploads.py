@@ -0,0 +1,235 @@
+import os
+import math
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+from typing import AsyncIterator, BinaryIO, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Uploaded documents are stored here (not in the database). With several
+# hosts this must be shared storage, since any worker may receive a part.
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", str(8 * 1024 * 1024)))
+UPLOAD_MIN_PART_SIZE = 256 * 1024
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(500 * 1024 * 1024)))
+# Open uploads with no part received for this long are expired, and new
+# uploads are refused while this many are open.
+UPLOAD_TTL_S = int(os.getenv("UPLOAD_TTL_S", str(24 * 3600)))
+UPLOAD_MAX_OPEN = int(os.getenv("UPLOAD_MAX_OPEN", "100"))
+UPLOAD_SWEEP_INTERVAL_S = int(os.getenv("UPLOAD_SWEEP_INTERVAL_S", "600"))
+
+# Read/write granularity when copying or hashing stored files.
+_BLOCK_SIZE = 1024 * 1024
+
+
+class PartError(ValueError):
+    """
+    A part's body doesn't match its declared size or checksum. `parts`
+    lists the stored parts found damaged, if any.
+    """
+
+    def __init__(self, message: str, parts: Sequence[int] = ()):
+        super().__init__(message)
+        self.parts = list(parts)
+
+
+class UploadClosed(Exception):
+    """
+    The upload's staging directory is gone: it was completed or expired.
+    """
+
+
+def _ensure_dirs():
+    os.makedirs(os.path.join(UPLOAD_DIR, "files"), exist_ok=True)
+
+
+def new_upload_id() -> str:
+    return uuid.uuid4().hex
+
+
+def staging_dir(upload_id: str) -> str:
+    """
+    Directory holding an upload's acknowledged parts, one file per part,
+    until completion.
+    """
+    return os.path.join(UPLOAD_DIR, f"{upload_id}.parts")
+
+
+def part_path(upload_id: str, part_number: int) -> str:
+    return os.path.join(staging_dir(upload_id), str(part_number))
+
+
+def storage_path_for(upload_id: str, filename: str) -> str:
+    """
+    Final location of a completed upload. The extension is kept because the
+    document loader is chosen by it.
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    return os.path.join(UPLOAD_DIR, "files", f"{upload_id}{ext}")
+
+
+def part_size_for(size_bytes: int, part_size: int, part_number: int) -> int:
+    """
+    Expected size of a (0-based) part; the last one holds the remainder.
+    """
+    return min(part_size, size_bytes - part_number * part_size)
+
+
+def create_staging_dir(upload_id: str):
+    _ensure_dirs()
+    os.makedirs(staging_dir(upload_id), exist_ok=True)
+
+
+def remove_staging_dir(upload_id: str):
+    shutil.rmtree(staging_dir(upload_id), ignore_errors=True)
+
+
+def staging_age_s(upload_id: str) -> float:
+    """
+    Seconds since a part was last stored for this upload (or since it was
+    started); infinite if its staging directory is gone.
+    """
+    try:
+        return time.time() - os.stat(staging_dir(upload_id)).st_mtime
+    except FileNotFoundError:
+        return math.inf
+
+
+def stale_staging_ids(max_age_s: float) -> list:
+    """
+    Upload IDs whose staging directory hasn't changed for `max_age_s`.
+    """
+    if not os.path.isdir(UPLOAD_DIR):
+        return []
+    ids = []
+    for name in os.listdir(UPLOAD_DIR):
+        if name.endswith(".parts"):
+            upload_id = name[: -len(".parts")]
+            if staging_age_s(upload_id) > max_age_s:
+                ids.append(upload_id)
+    return ids
+
+
+async def write_part(
+    upload_id: str,
+    part_number: int,
+    expected_size: int,
+    expected_checksum: str,
+    chunks: AsyncIterator[bytes],
+) -> Tuple[int, str]:
+    """
+    Streams a part's body into a temporary file, hashing it on the way, so
+    at most one network chunk is held in memory. The part replaces any
+    earlier copy only once its size and SHA-256 match, so a damaged re-send
+    can't overwrite a good part. Returns the part's size and SHA-256.
+    """
+    target = part_path(upload_id, part_number)
+    temp = f"{target}.{new_upload_id()}.tmp"
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        out = await asyncio.to_thread(open, temp, "wb")
+    except FileNotFoundError:
+        raise UploadClosed(f"Upload {upload_id} is no longer open")
+    try:
+        try:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                if written + len(chunk) > expected_size:
+                    raise PartError(
+                        f"Part is larger than the expected {expected_size} bytes"
+                    )
+                digest.update(chunk)
+                await asyncio.to_thread(out.write, chunk)
+                written += len(chunk)
+        finally:
+            await asyncio.to_thread(out.close)
+        if written != expected_size:
+            raise PartError(f"Part has {written} bytes, expected {expected_size}")
+        if digest.hexdigest() != expected_checksum:
+            raise PartError("Part checksum mismatch")
+        try:
+            await asyncio.to_thread(os.replace, temp, target)
+        except FileNotFoundError:
+            raise UploadClosed(f"Upload {upload_id} is no longer open")
+    finally:
+        await asyncio.to_thread(remove_stored_file, temp)
+    return written, digest.hexdigest()
+
+
+def finalize_staging_file(
+    upload_id: str, filename: str, checksums: Sequence[str]
+) -> Tuple[str, str]:
+    """
+    Concatenates an upload's parts into its storage path, hashing the whole
+    file on the way. Each part is re-checked against its acknowledged
+    SHA-256 (`checksums`, by part number); damaged or missing parts raise
+    PartError and nothing is stored. Returns (storage_path, content_hash).
+    Blocking; run it off the event loop.
+    """
+    target = storage_path_for(upload_id, filename)
+    temp = f"{target}.tmp"
+    digest = hashlib.sha256()
+    damaged = []
+    try:
+        with open(temp, "wb") as out:
+            for part_number, checksum in enumerate(checksums):
+                part_digest = hashlib.sha256()
+                try:
+                    with open(part_path(upload_id, part_number), "rb") as f:
+                        for block in iter(lambda: f.read(_BLOCK_SIZE), b""):
+                            part_digest.update(block)
+                            digest.update(block)
+                            out.write(block)
+                except FileNotFoundError:
+                    damaged.append(part_number)
+                    continue
+                if part_digest.hexdigest() != checksum:
+                    damaged.append(part_number)
+        if damaged:
+            raise PartError(f"Parts {damaged} are damaged; send them again", damaged)
+        os.replace(temp, target)
+    finally:
+        remove_stored_file(temp)
+    remove_staging_dir(upload_id)
+    return target, digest.hexdigest()
+
+
+def store_stream(source: BinaryIO, filename: str) -> Tuple[str, int, str]:
+    """
+    Copies a file object (e.g. a single-request upload) to storage in
+    blocks, hashing it on the way. Returns (storage_path, size_bytes,
+    content_hash). Blocking; run it off the event loop.
+    """
+    _ensure_dirs()
+    target = storage_path_for(new_upload_id(), filename)
+    digest = hashlib.sha256()
+    size = 0
+    with open(target, "wb") as out:
+        for block in iter(lambda: source.read(_BLOCK_SIZE), b""):
+            digest.update(block)
+            out.write(block)
+            size += len(block)
+    return target, size, digest.hexdigest()
+
+
+def remove_stored_file(path: str):
+    """
+    Deletes a stored or temporary file; missing files are ignored.
+    """
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def copy_stored_file(path: str, destination: str):
+    shutil.copyfile(path, destination)
@@ -0,0 +1,46 @@
+from logging.config import fileConfig
+
+import sqlalchemy
+from alembic import context
+
+from backend.db import get_sync_database_url, metadata
+
+config = context.config
+
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = metadata
+
+
+def run_migrations_offline():
+    """
+    Emits the migration SQL to stdout without connecting to the database.
+    """
+    context.configure(
+        url=get_sync_database_url(),
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    """
+    Runs the migrations against the database in DATABASE_URL.
+    """
+    engine = sqlalchemy.create_engine(
+        get_sync_database_url(), poolclass=sqlalchemy.pool.NullPool
+    )
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,30 @@
+"""Create the files table.
+
+Databases created by the old import-time `metadata.create_all` already have
+this table; mark them with `alembic stamp 0001` before upgrading.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "files",
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("filename", sa.String(255), nullable=False),
+        sa.Column("data", sa.LargeBinary, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("files")
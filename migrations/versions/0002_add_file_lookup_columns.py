@@ -0,0 +1,33 @@
+"""Add content hash and ingestion status, and index the lookup columns.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("files", sa.Column("content_hash", sa.String(64), nullable=True))
+    op.add_column(
+        "files",
+        sa.Column("status", sa.String(16), nullable=False, server_default="pending"),
+    )
+    op.create_index("ix_files_filename", "files", ["filename"])
+    op.create_index("ix_files_content_hash", "files", ["content_hash"])
+    op.create_index("ix_files_status", "files", ["status"])
+
+
+def downgrade():
+    op.drop_index("ix_files_status", table_name="files")
+    op.drop_index("ix_files_content_hash", table_name="files")
+    op.drop_index("ix_files_filename", table_name="files")
+    op.drop_column("files", "status")
+    op.drop_column("files", "content_hash")
@@ -0,0 +1,76 @@
+"""Move file metadata into its own table so lookups never read the blob.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "file_metadata",
+        sa.Column(
+            "file_id",
+            sa.Integer,
+            sa.ForeignKey("files.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("filename", sa.String(255), nullable=False),
+        sa.Column("size_bytes", sa.BigInteger, nullable=False),
+        sa.Column("page_count", sa.Integer, nullable=True),
+        sa.Column("chunk_count", sa.Integer, nullable=True),
+        sa.Column("content_hash", sa.String(64), nullable=True),
+        sa.Column("status", sa.String(16), nullable=False, server_default="pending"),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            nullable=False,
+            server_default=sa.func.now(),
+        ),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(timezone=True),
+            nullable=False,
+            server_default=sa.func.now(),
+        ),
+    )
+    op.create_index("ix_file_metadata_filename", "file_metadata", ["filename"])
+    op.create_index("ix_file_metadata_content_hash", "file_metadata", ["content_hash"])
+    op.create_index("ix_file_metadata_status", "file_metadata", ["status"])
+
+    # One-off backfill; this is the last query allowed to read `files.data`
+    # for metadata purposes.
+    op.execute(
+        "INSERT INTO file_metadata (file_id, filename, size_bytes, content_hash, status) "
+        "SELECT id, filename, length(data), content_hash, status FROM files"
+    )
+
+    op.drop_index("ix_files_status", table_name="files")
+    op.drop_index("ix_files_content_hash", table_name="files")
+    with op.batch_alter_table("files") as batch_op:
+        batch_op.drop_column("status")
+        batch_op.drop_column("content_hash")
+
+
+def downgrade():
+    with op.batch_alter_table("files") as batch_op:
+        batch_op.add_column(sa.Column("content_hash", sa.String(64), nullable=True))
+        batch_op.add_column(
+            sa.Column("status", sa.String(16), nullable=False, server_default="pending")
+        )
+    op.execute(
+        "UPDATE files SET content_hash = (SELECT content_hash FROM file_metadata "
+        "WHERE file_metadata.file_id = files.id), status = COALESCE((SELECT status "
+        "FROM file_metadata WHERE file_metadata.file_id = files.id), 'pending')"
+    )
+    op.create_index("ix_files_content_hash", "files", ["content_hash"])
+    op.create_index("ix_files_status", "files", ["status"])
+    op.drop_table("file_metadata")
@@ -0,0 +1,62 @@
+"""Store file bytes on disk and add resumable chunked-upload sessions.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # New uploads are streamed to UPLOAD_DIR and only their path is stored;
+    # rows written before this keep their bytes in `data`.
+    with op.batch_alter_table("files") as batch_op:
+        batch_op.alter_column("data", existing_type=sa.LargeBinary, nullable=True)
+        batch_op.add_column(sa.Column("storage_path", sa.String(1024), nullable=True))
+
+    op.create_table(
+        "uploads",
+        sa.Column("id", sa.String(32), primary_key=True),
+        sa.Column("filename", sa.String(255), nullable=False),
+        sa.Column("size_bytes", sa.BigInteger, nullable=False),
+        sa.Column("part_size", sa.Integer, nullable=False),
+        sa.Column("part_count", sa.Integer, nullable=False),
+        sa.Column("status", sa.String(16), nullable=False, server_default="open"),
+        sa.Column("file_id", sa.Integer, nullable=True),
+        sa.Column(
+            "created_at",
+            sa.DateTime(timezone=True),
+            nullable=False,
+            server_default=sa.func.now(),
+        ),
+    )
+    op.create_table(
+        "upload_parts",
+        sa.Column(
+            "upload_id",
+            sa.String(32),
+            sa.ForeignKey("uploads.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("part_number", sa.Integer, primary_key=True),
+        sa.Column("size_bytes", sa.Integer, nullable=False),
+        sa.Column("checksum", sa.String(64), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("upload_parts")
+    op.drop_table("uploads")
+    # Files stored on disk have no bytes in `data`; they are dropped, since
+    # the old schema can't represent them.
+    op.execute("DELETE FROM files WHERE data IS NULL")
+    with op.batch_alter_table("files") as batch_op:
+        batch_op.drop_column("storage_path")
+        batch_op.alter_column("data", existing_type=sa.LargeBinary, nullable=False)
@@ -0,0 +1,33 @@
+"""Move the chunk docstore into the shared database.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Chunk text used to live in a per-host SQLite file, which other hosts
+    # couldn't read. Files ingested before this need to be re-uploaded.
+    op.create_table(
+        "docstore_chunks",
+        sa.Column("id", sa.String(128), primary_key=True),
+        sa.Column("file_id", sa.String(32), nullable=False),
+        sa.Column("token_count", sa.Integer, nullable=False, server_default="0"),
+        sa.Column("text", sa.LargeBinary, nullable=False),
+        sa.Column("metadata", sa.Text, nullable=False),
+    )
+    op.create_index("ix_docstore_chunks_file_id", "docstore_chunks", ["file_id"])
+
+
+def downgrade():
+    op.drop_index("ix_docstore_chunks_file_id", table_name="docstore_chunks")
+    op.drop_table("docstore_chunks")
@@ -4,8 +4,12 @@ from rag_project.file_card import uploaded_file_card
 from rag_project.style import *
 
 
-def message_bubble(message: Message, index: int) -> rx.Component:
-    """A message bubble component for the chat."""
+def message_bubble(message: Message) -> rx.Component:
+    """A message bubble component for the chat.
+
+    Only used for finalized messages, which never change while an answer
+    streams; the in-progress answer is rendered by `streaming_bubble`.
+    """
     is_user = message["role"] == "user"
     bubble_style = rx.cond(
         is_user, "flex flex-col items-end gap-2", "flex items-start gap-3"
@@ -53,34 +57,39 @@ def message_bubble(message: Message, index: int) -> rx.Component:
             class_name="flex items-start gap-3 justify-end w-[50%]",
         )
 
-    def assistant_message(index: int) -> rx.Component:
-
-        # --- 2. CREATE A CONDITIONAL CLASS FOR THE ICON ---
-        icon_class = rx.cond(
-            # If it's the last message AND we are still processing...
-            (RAGState.is_processing) & (index == (RAGState.messages.length() - 1)),
-            # ...then blink.
-            f"{icon_style} p-1.5 bg-[#4f3a69] text-white animate-pulse",
-            # ...otherwise, be static.
-            f"{icon_style} p-1.5 bg-[#4f3a69] text-white",
-        )
-
+    def assistant_message() -> rx.Component:
         return rx.el.div(
-            # --- 3. USE THE CONDITIONAL CLASS ---
             rx.icon(
                 "bot-message-square",
-                class_name=icon_class,
+                class_name=f"{icon_style} p-1.5 bg-[#4f3a69] text-white",
             ),
             render_message_content(),
             class_name="flex items-start gap-3",
         )
 
     return rx.el.div(
-        rx.cond(is_user, user_message(), assistant_message(index=index)),
+        rx.cond(is_user, user_message(), assistant_message()),
         class_name=bubble_style,
     )
 
 
+def streaming_bubble() -> rx.Component:
+    """The assistant answer currently being streamed, with a blinking icon."""
+    return rx.el.div(
+        rx.icon(
+            "bot-message-square",
+            class_name="h-8 w-8 rounded-full flex-shrink-0 p-1.5 bg-[#4f3a69] text-white animate-pulse",
+        ),
+        rx.el.div(
+            rx.markdown(
+                RAGState.streaming_content, class_name="text-white/90 pt-0 pb-0"
+            ),
+            class_name="p-3 rounded-2xl bg-transparent",
+        ),
+        class_name="flex items-start gap-3",
+    )
+
+
 def chat_input_area() -> rx.Component:
     """The chat input area with file upload and send button."""
     return rx.el.div(
@@ -155,7 +164,27 @@ def chat_area() -> rx.Component:
                 class_name="flex flex-col items-center justify-center text-center h-full",
             ),
             rx.el.div(
+                rx.cond(
+                    RAGState.has_older_messages,
+                    rx.el.div(
+                        rx.el.button(
+                            "Load older messages",
+                            on_click=RAGState.load_older,
+                            type="button",
+                            class_name="text-sm text-[#baa7d1] hover:underline",
+                        ),
+                        class_name="flex justify-center",
+                    ),
+                ),
                 rx.foreach(RAGState.messages, message_bubble),
+                rx.cond(RAGState.is_processing, streaming_bubble()),
+                rx.cond(
+                    RAGState.is_queued,
+                    rx.el.p(
+                        "Queued — waiting for the server to pick up your question...",
+                        class_name="text-sm text-[#baa7d1] animate-pulse pl-11",
+                    ),
+                ),
                 # rx.cond(
                 #     RAGState.is_processing,
                 #     rx.el.div(
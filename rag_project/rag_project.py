@@ -1,5 +1,6 @@
 import reflex as rx
 from rag_project.chat import chat_input_area, chat_area
+from rag_project.state import warm_up_backend_client
 
 
 def index() -> rx.Component:
@@ -22,4 +23,5 @@ app = rx.App(
         ),
     ],
 )
+app.register_lifespan_task(warm_up_backend_client)
 app.add_page(index, title="RAG UI Demo")
\ No newline at end of file
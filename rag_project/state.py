@@ -1,9 +1,150 @@
 import reflex as rx
 from typing import TypedDict, Optional
+import os
 import asyncio
+import contextlib
 import logging
+import time
+import hashlib
 import httpx
 
+BACKEND_URL = os.getenv("BACKEND_URL", "http://localhost:9000")
+
+# The read timeout covers waiting in the backend's admission queue for the
+# response headers and, after that, the longest gap between streamed chunks.
+QUERY_TIMEOUT = httpx.Timeout(connect=5.0, read=90.0, write=10.0, pool=10.0)
+
+# Number of messages rendered at once; older ones are paged in on request.
+MESSAGE_WINDOW = int(os.getenv("MESSAGE_WINDOW", "40"))
+# Streamed tokens are coalesced into one state update per interval.
+STREAM_FLUSH_INTERVAL_S = 0.05
+
+# Chunked uploads: parts sent at once, retries per part, and how often to
+# poll ingestion status afterwards. Reflex has already read the whole file
+# into memory by the time handle_upload runs, so parts bound the backend's
+# memory, not this process's.
+UPLOAD_PARALLELISM = int(os.getenv("UPLOAD_PARALLELISM", "4"))
+UPLOAD_PART_RETRIES = 3
+UPLOAD_PART_TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=60.0, pool=30.0)
+INGEST_POLL_INTERVAL_S = 1.0
+INGEST_POLL_TIMEOUT_S = 900
+
+_backend_client: Optional[httpx.AsyncClient] = None
+
+
+def get_backend_client() -> httpx.AsyncClient:
+    """
+    Returns the shared (keep-alive) HTTP client used to talk to the backend,
+    creating it on first use. Timeouts are set per request.
+    """
+    global _backend_client
+    if _backend_client is None or _backend_client.is_closed:
+        _backend_client = httpx.AsyncClient(base_url=BACKEND_URL)
+    return _backend_client
+
+
+@contextlib.asynccontextmanager
+async def warm_up_backend_client():
+    """
+    Reflex lifespan task: opens the shared backend client and makes a first
+    request so the connection is established before the first user action.
+    """
+    try:
+        response = await get_backend_client().get("/ready", timeout=5.0)
+        logging.info(f"Backend readiness: {response.status_code} {response.text}")
+    except httpx.HTTPError as e:
+        logging.warning(f"Backend not reachable during warm-up: {e}")
+    yield
+    if _backend_client is not None:
+        await _backend_client.aclose()
+
+
+def _file_size(file: rx.UploadFile) -> int:
+    if file.size is not None:
+        return file.size
+    file.file.seek(0, os.SEEK_END)
+    return file.file.tell()
+
+
+def _fingerprint(file: rx.UploadFile) -> str:
+    """
+    SHA-256 of the file's content. Pending uploads are keyed on it, so only
+    the same content resumes an interrupted upload; blocking.
+    """
+    digest = hashlib.sha256()
+    file.file.seek(0)
+    for block in iter(lambda: file.file.read(1024 * 1024), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+async def _start_upload(file: rx.UploadFile, size: int, resume_id: Optional[str]) -> dict:
+    """
+    Resumes an earlier upload of this file if the backend still has it,
+    otherwise starts a new one. Returns the upload's status.
+    """
+    client = get_backend_client()
+    if resume_id:
+        response = await client.get(f"/uploads/{resume_id}", timeout=10.0)
+        if response.status_code == 200 and response.json()["size_bytes"] == size:
+            upload = response.json()
+            logging.info(
+                f"Resuming upload {resume_id}: "
+                f"{len(upload['received_parts'])}/{upload['part_count']} parts received"
+            )
+            return upload
+    response = await client.post(
+        "/uploads", json={"filename": file.name, "size_bytes": size}, timeout=10.0
+    )
+    response.raise_for_status()
+    return {**response.json(), "status": "open", "received_parts": []}
+
+
+async def _send_part(upload_id: str, part_number: int, data: bytes):
+    """Sends one part with its checksum, retrying transient failures."""
+    checksum = hashlib.sha256(data).hexdigest()
+    for attempt in range(UPLOAD_PART_RETRIES):
+        try:
+            response = await get_backend_client().put(
+                f"/uploads/{upload_id}/parts/{part_number}",
+                content=data,
+                headers={"X-Part-Checksum": checksum},
+                timeout=UPLOAD_PART_TIMEOUT,
+            )
+            response.raise_for_status()
+            return
+        except (httpx.RequestError, httpx.HTTPStatusError) as e:
+            # 400 is a size/checksum mismatch, i.e. the part was damaged in transit.
+            retryable = isinstance(e, httpx.RequestError) or (
+                e.response.status_code == 400 or e.response.status_code >= 500
+            )
+            if not retryable or attempt == UPLOAD_PART_RETRIES - 1:
+                raise
+            logging.warning(f"Retrying part {part_number} of {upload_id}: {e}")
+            await asyncio.sleep(2**attempt)
+
+
+async def _send_missing_parts(file: rx.UploadFile, upload: dict):
+    """
+    Sends the parts the backend hasn't acknowledged, UPLOAD_PARALLELISM at
+    a time. A part is only read from the file once it can be sent.
+    """
+    received = set(upload["received_parts"])
+    part_size = upload["part_size"]
+    semaphore = asyncio.Semaphore(UPLOAD_PARALLELISM)
+    read_lock = asyncio.Lock()
+
+    async def send(part_number: int):
+        async with semaphore:
+            async with read_lock:
+                file.file.seek(part_number * part_size)
+                data = file.file.read(part_size)
+            await _send_part(upload["upload_id"], part_number, data)
+
+    await asyncio.gather(
+        *(send(n) for n in range(upload["part_count"]) if n not in received)
+    )
+
 
 class UploadedFile(TypedDict):
     filename: str
@@ -17,12 +158,59 @@ class Message(TypedDict):
 
 
 class RAGState(rx.State):
-    """The state for the RAG application."""
+    """The state for the RAG application.
+
+    `messages` is only the rendered window (the newest messages, plus any
+    older pages loaded on request). The full conversation lives in the
+    backend-only `_archive`, so finalized messages aren't re-sent to the
+    browser. The answer being streamed lives in `streaming_content` until
+    it is finished, so each token only sends that string.
+    """
 
     messages: list[Message] = []
+    has_older_messages: bool = False
+    streaming_content: str = ""
     is_processing: bool = False
+    is_queued: bool = False
     uploaded_files: list[UploadedFile] = []
 
+    # "<filename>:<size>:<sha256>" -> upload id of an interrupted upload, so
+    # dropping the same file again resumes it. Keyed on content, so a
+    # different file with the same name and size starts a new upload
+    # instead of mixing in the first file's parts.
+    _pending_uploads: dict[str, str] = {}
+    _archive: list[Message] = []
+    _visible_count: int = MESSAGE_WINDOW
+    # file_id -> archive indices of the messages that attach it.
+    _file_index: dict[int, list[int]] = {}
+
+    def _window_start(self) -> int:
+        return max(len(self._archive) - self._visible_count, 0)
+
+    def _refresh_window(self):
+        start = self._window_start()
+        self.messages = self._archive[start:]
+        self.has_older_messages = start > 0
+
+    def _append_message(self, message: Message):
+        """
+        Archives a finalized message and slides the window over it. Pages
+        loaded with load_older are dropped again, so the rendered (and
+        re-sent) list never grows past MESSAGE_WINDOW for a new turn.
+        """
+        self._visible_count = MESSAGE_WINDOW
+        index = len(self._archive)
+        self._archive.append(message)
+        for f in message["attached_files"] or []:
+            self._file_index.setdefault(f["file_id"], []).append(index)
+        self._refresh_window()
+
+    @rx.event
+    def load_older(self):
+        """Pages the previous MESSAGE_WINDOW messages into the rendered window."""
+        self._visible_count += MESSAGE_WINDOW
+        self._refresh_window()
+
     @rx.event
     async def handle_upload(self, files: list[rx.UploadFile]):
         """Handle the upload of files by sending them to the FastAPI backend."""
@@ -31,42 +219,101 @@ class RAGState(rx.State):
             return
         for file in files:
             try:
-                upload_data = await file.read()
-                async with httpx.AsyncClient(timeout=60.0) as client:
-                    response = await client.post(
-                        "http://localhost:9000/upload",
-                        files={"file": (file.name, upload_data, file.content_type)},
+                size = _file_size(file)
+                fingerprint = await asyncio.to_thread(_fingerprint, file)
+                key = f"{file.name}:{size}:{fingerprint}"
+                upload = await _start_upload(
+                    file, size, self._pending_uploads.get(key)
+                )
+                self._pending_uploads[key] = upload["upload_id"]
+
+                # A resumed upload may already be complete (and ingesting).
+                if upload.get("file_id") is None:
+                    if upload["status"] == "open":
+                        await _send_missing_parts(file, upload)
+                    response = await get_backend_client().post(
+                        f"/uploads/{upload['upload_id']}/complete", timeout=60.0
                     )
                     response.raise_for_status()
                     response_data = response.json()
-                    message = response_data.get(
-                        "message", f"File '{file.name}' processed."
+                else:
+                    response_data = {
+                        "file_id": upload["file_id"],
+                        "filename": upload["filename"],
+                    }
+                if response_data.get("file_id") is None:
+                    # Keep the pending upload, so dropping the file again resumes it.
+                    raise ValueError("The upload has no file yet. Please retry.")
+                self._pending_uploads.pop(key, None)
+
+                message = response_data.get(
+                    "message", f"File '{file.name}' uploaded."
+                )
+                self.uploaded_files.clear()
+                self.uploaded_files.append(
+                    {
+                        "filename": response_data["filename"],
+                        "file_id": response_data["file_id"],
+                    }
+                )
+                yield rx.toast.info(f"{message} Indexing...")
+                yield RAGState.watch_ingestion(
+                    response_data["file_id"], response_data["filename"]
+                )
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 429:
+                    retry_after = e.response.headers.get("Retry-After", "a few")
+                    yield rx.toast.warning(
+                        f"The server is busy. Please retry the upload in {retry_after} seconds."
                     )
-                    self.uploaded_files.clear()
-                    self.uploaded_files.append(
-                        {
-                            "filename": response_data["filename"],
-                            "file_id": response_data["file_id"],
-                        }
+                else:
+                    logging.exception(f"Error uploading file: {e}")
+                    yield rx.toast.error(
+                        f"Error uploading file: {e.response.json().get('detail', e.response.text)}"
                     )
-                    yield rx.toast.success(message)
             except httpx.RequestError as e:
                 logging.exception(f"Backend connection error during upload: {e}")
                 yield rx.toast.error(
-                    "Error: Could not connect to the backend to upload file."
+                    "Error: Upload interrupted. Drop the file again to resume."
                 )
             except Exception as e:
                 logging.exception(f"An error occurred during file upload: {e}")
                 yield rx.toast.error(f"An unexpected error occurred: {str(e)}")
 
+    @rx.event(background=True)
+    async def watch_ingestion(self, file_id: int, filename: str):
+        """Polls a file's ingestion status until it is ready or failed."""
+        deadline = time.monotonic() + INGEST_POLL_TIMEOUT_S
+        while time.monotonic() < deadline:
+            try:
+                response = await get_backend_client().get(
+                    f"/file/{file_id}/stat", timeout=10.0
+                )
+                if response.status_code == 404:
+                    return
+                response.raise_for_status()
+                status = response.json()["status"]
+            except httpx.HTTPError as e:
+                logging.warning(f"Could not poll ingestion status: {e}")
+                status = None
+            if status == "ready":
+                yield rx.toast.success(f"'{filename}' is ready for questions.")
+                return
+            if status == "failed":
+                yield rx.toast.error(f"Indexing '{filename}' failed. Please re-upload it.")
+                return
+            await asyncio.sleep(INGEST_POLL_INTERVAL_S)
+        yield rx.toast.warning(f"'{filename}' is still being indexed.")
+
     @rx.event(background=True)
     async def remove_file(self, file_id: int):
         """Remove a file from the database and the uploaded files list."""
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.delete(f"http://localhost:9000/file/{file_id}")
-                response.raise_for_status()
-                response_data = response.json()
+            response = await get_backend_client().delete(
+                f"/file/{file_id}", timeout=30.0
+            )
+            response.raise_for_status()
+            response_data = response.json()
             async with self:
                 filename_to_remove = ""
                 for f in self.uploaded_files:
@@ -76,13 +323,16 @@ class RAGState(rx.State):
                 self.uploaded_files = [
                     f for f in self.uploaded_files if f["file_id"] != file_id
                 ]
-                for i in range(len(self.messages)):
-                    if self.messages[i]["attached_files"]:
-                        self.messages[i]["attached_files"] = [
-                            f
-                            for f in self.messages[i]["attached_files"]
-                            if f["file_id"] != file_id
-                        ]
+                start = self._window_start()
+                for i in self._file_index.pop(file_id, []):
+                    attached = [
+                        f
+                        for f in self._archive[i]["attached_files"]
+                        if f["file_id"] != file_id
+                    ]
+                    self._archive[i]["attached_files"] = attached
+                    if i >= start:
+                        self.messages[i - start]["attached_files"] = attached
             yield rx.toast.success(
                 response_data.get("message", f"Removed file: {filename_to_remove}")
             )
@@ -106,15 +356,16 @@ class RAGState(rx.State):
         query = form_data.get("query", "").strip()
         if not query and (not self.uploaded_files):
             return rx.toast.warning("Query cannot be empty.")
-        attached_files = self.uploaded_files
+        attached_files = list(self.uploaded_files)
         self.uploaded_files = []
-        self.messages.append(
+        self._append_message(
             {
                 "role": "user",
                 "content": query or "Sent files",
                 "attached_files": attached_files if attached_files else None,
             }
         )
+        self.streaming_content = ""
         self.is_processing = True
         yield RAGState.get_backend_response
 
@@ -122,52 +373,102 @@ class RAGState(rx.State):
     async def get_backend_response(self):
         """Get a response from the backend RAG model."""
         async with self:
-            last_message = self.messages[-1]
+            last_message = self._archive[-1]
             query = last_message["content"]
             file_id = (
                 last_message["attached_files"][0]["file_id"]
                 if last_message["attached_files"]
                 else None
             )
-            payload = {"query": query, "file_id": file_id}
+            payload = {
+                "query": query,
+                "file_id": file_id,
+                "session_id": self.router.session.client_token,
+            }
 
         async with self:
-            self.messages.append(
-                {
-                    "role": "assistant",
-                    "content": "",
-                    "attached_files": None,
-                }
-            )
+            # The backend only sends response headers once the query has been
+            # admitted, so until then we are waiting in its queue.
+            self.is_queued = True
 
         try:
-            async with httpx.AsyncClient(timeout=None) as client:
-                async with client.stream(
-                    "POST", "http://localhost:9000/process-query", json=payload
-                ) as response:
+            async with get_backend_client().stream(
+                "POST", "/process-query", json=payload, timeout=QUERY_TIMEOUT
+            ) as response:
+                async with self:
+                    self.is_queued = False
 
-                    if response.status_code != 200:
-                        async with self:
-                            self.messages[-1][
-                                "content"
-                            ] = f"Error: {response.status_code} - Could not get response."
-                        return  # Stop
+                if response.status_code == 429:
+                    retry_after = response.headers.get("Retry-After", "a few")
+                    async with self:
+                        self.streaming_content = (
+                            "The server is busy right now. "
+                            f"Please try again in {retry_after} seconds."
+                        )
+                    return
 
-                    async for chunk in response.aiter_text():
-                        if chunk:
-                            async with self:
-                                self.messages[-1]["content"] += chunk
+                if response.status_code != 200:
+                    await response.aread()
+                    try:
+                        detail = response.json().get("detail", response.text)
+                    except ValueError:
+                        detail = response.text
+                    async with self:
+                        self.streaming_content = (
+                            f"Error {response.status_code}: {detail or 'Could not get response.'}"
+                        )
+                    return  # Stop
 
-        except httpx.RequestError as e:
+                pending = ""
+                last_flush = time.monotonic()
+                async for chunk in response.aiter_text():
+                    pending += chunk
+                    if pending and time.monotonic() - last_flush >= STREAM_FLUSH_INTERVAL_S:
+                        async with self:
+                            self.streaming_content += pending
+                        pending = ""
+                        last_flush = time.monotonic()
+                if pending:
+                    async with self:
+                        self.streaming_content += pending
+
+        except httpx.ConnectError as e:
             logging.exception(f"Backend connection error: {e}")
             async with self:
-                self.messages[-1][
-                    "content"
-                ] = "Error: Could not connect to the backend."
+                self.streaming_content = "Error: Could not connect to the backend."
+        except (httpx.TimeoutException, httpx.RemoteProtocolError) as e:
+            logging.exception(f"Backend stopped responding: {e}")
+            reason = (
+                "timed out"
+                if isinstance(e, httpx.TimeoutException)
+                else "closed the connection"
+            )
+            async with self:
+                if self.streaming_content:
+                    self.streaming_content += (
+                        f"\n\n_The backend {reason}; the answer above may be incomplete._"
+                    )
+                else:
+                    self.streaming_content = (
+                        f"Error: The backend {reason} before answering. Please try again."
+                    )
+        except httpx.RequestError as e:
+            logging.exception(f"Backend request error: {e}")
+            async with self:
+                self.streaming_content = f"Error: Request to the backend failed ({e})."
         except Exception as e:
             logging.exception(f"An error occurred while getting response: {e}")
             async with self:
-                self.messages[-1]["content"] = f"An unexpected error occurred: {str(e)}"
+                self.streaming_content = f"An unexpected error occurred: {str(e)}"
         finally:
             async with self:
+                self._append_message(
+                    {
+                        "role": "assistant",
+                        "content": self.streaming_content,
+                        "attached_files": None,
+                    }
+                )
+                self.streaming_content = ""
+                self.is_queued = False
                 self.is_processing = False
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""
+Admission slots are released however a streamed answer ends, including a
+client that disconnects before the first chunk is sent.
+"""
+
+import json
+import asyncio
+
+import pytest
+
+from backend import main
+from backend.admission import AdmissionController
+
+
+def _disconnect_before_first_chunk(spec_version: str):
+    """
+    Sends a query to /process-query over raw ASGI and drops the connection
+    before any of the body is sent.
+    """
+    body = json.dumps({"query": "What is RAG?"}).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": spec_version},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/process-query",
+        "raw_path": b"/process-query",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 5000),
+        "server": ("testserver", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if spec_version >= "2.4":
+            raise OSError("connection reset")
+        # Never get as far as the first body chunk.
+        await asyncio.sleep(3600)
+
+    async def run():
+        try:
+            await asyncio.wait_for(main.app(scope, receive, send), timeout=5)
+        except Exception:
+            pass
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("spec_version", ["2.3", "2.4"])
+def test_disconnect_before_first_chunk_releases_slot(monkeypatch, spec_version):
+    controller = AdmissionController(max_in_flight=1)
+    started = []
+
+    def answer(**kwargs):
+        started.append(True)
+        yield "never sent"
+
+    monkeypatch.setattr(main, "admission", controller)
+    monkeypatch.setattr(main, "get_streaming_answer", answer)
+
+    _disconnect_before_first_chunk(spec_version)
+
+    assert not started
+    assert controller.metrics()["in_flight"] == 0
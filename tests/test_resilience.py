@@ -0,0 +1,256 @@
+"""
+Hedging, deadlines, circuit breaking and fallbacks against local fake
+upstreams with injected latency (backend.resilience.fake_remote).
+"""
+
+import time
+
+import pytest
+
+from backend.cache import InMemoryCache
+from backend.resilience import (
+    HEDGE_MIN_SAMPLES,
+    AnswerCache,
+    CircuitBreaker,
+    CircuitOpen,
+    Upstream,
+    UpstreamTimeout,
+    fake_remote,
+)
+
+
+def _timed(fn, *args, **kwargs):
+    started = time.monotonic()
+    result = fn(*args, **kwargs)
+    return result, time.monotonic() - started
+
+
+def _open_breaker(upstream: Upstream, threshold: int = 2, reset_s: float = 0.1):
+    upstream.breaker = CircuitBreaker(threshold=threshold, reset_s=reset_s)
+    failing = fake_remote(0, error=ConnectionError("down"))
+    for _ in range(threshold):
+        with pytest.raises(ConnectionError):
+            upstream.call(failing)
+    assert upstream.breaker.state == CircuitBreaker.OPEN
+
+
+def _slow_stream(delays_s):
+    def make_stream():
+        for i, delay in enumerate(delays_s):
+            time.sleep(delay)
+            yield f"token-{i}"
+
+    return make_stream
+
+
+def test_hedge_wins_when_primary_is_slow():
+    upstream = Upstream("fake-hedged", timeout_s=5.0, hedge=True)
+    # Fast calls teach the upstream its p95; then one primary stalls for 2s.
+    remote = fake_remote(5, schedule_ms=[5] * HEDGE_MIN_SAMPLES + [2000])
+    for _ in range(HEDGE_MIN_SAMPLES):
+        upstream.call(remote)
+
+    result, elapsed = _timed(upstream.call, remote)
+
+    assert result == "ok"
+    assert elapsed < 0.5
+    metrics = upstream.metrics()
+    assert metrics["hedges"] == 1
+    assert metrics["hedge_wins"] == 1
+
+
+def test_no_hedge_without_latency_history():
+    upstream = Upstream("fake-cold", timeout_s=5.0, hedge=True)
+
+    result, elapsed = _timed(upstream.call, fake_remote(0, schedule_ms=[200]))
+
+    assert result == "ok"
+    assert elapsed >= 0.2
+    assert upstream.metrics()["hedges"] == 0
+
+
+def test_call_deadline_times_out():
+    upstream = Upstream("fake-slow", timeout_s=0.1)
+    started = time.monotonic()
+
+    with pytest.raises(UpstreamTimeout):
+        upstream.call(fake_remote(1000))
+    assert time.monotonic() - started < 0.5
+    assert upstream.metrics()["timeouts"] == 1
+
+
+def test_stream_first_token_deadline():
+    upstream = Upstream("fake-llm", timeout_s=5.0)
+    stream = upstream.stream(_slow_stream([1.0]), first_token_timeout_s=0.1)
+
+    with pytest.raises(UpstreamTimeout, match="no response"):
+        next(stream)
+    assert upstream.metrics()["timeouts"] == 1
+
+
+def test_stream_idle_deadline_keeps_earlier_tokens():
+    upstream = Upstream("fake-llm", timeout_s=5.0)
+    received = []
+
+    with pytest.raises(UpstreamTimeout, match="mid-answer"):
+        for token in upstream.stream(
+            _slow_stream([0, 1.0]), first_token_timeout_s=1.0, idle_timeout_s=0.1
+        ):
+            received.append(token)
+    assert received == ["token-0"]
+
+
+def test_breaker_opens_half_opens_and_closes():
+    upstream = Upstream("fake-flaky", timeout_s=1.0)
+    _open_breaker(upstream)
+
+    with pytest.raises(CircuitOpen):
+        upstream.call(fake_remote(0))
+    assert upstream.metrics()["short_circuits"] == 1
+
+    time.sleep(0.15)
+    states = []
+
+    def trial():
+        states.append(upstream.breaker.state)
+        return "ok"
+
+    assert upstream.call(trial) == "ok"
+    assert states == [CircuitBreaker.HALF_OPEN]
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_failed_trial_reopens_breaker():
+    upstream = Upstream("fake-flaky", timeout_s=1.0)
+    _open_breaker(upstream)
+    time.sleep(0.15)
+
+    with pytest.raises(ConnectionError):
+        upstream.call(fake_remote(0, error=ConnectionError("still down")))
+    assert upstream.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        upstream.call(fake_remote(0))
+
+
+def test_half_open_admits_only_one_trial_at_a_time():
+    breaker = CircuitBreaker(threshold=1, reset_s=0.1)
+    breaker.record_failure()
+    time.sleep(0.15)
+
+    assert breaker.allow()
+    assert not breaker.allow()
+
+
+def test_abandoned_stream_trial_settles_breaker():
+    upstream = Upstream("fake-llm", timeout_s=1.0)
+    _open_breaker(upstream)
+    time.sleep(0.15)
+
+    stream = upstream.stream(_slow_stream([0, 0, 0]))
+    assert next(stream) == "token-0"
+    stream.close()  # e.g. the client disconnected mid-answer
+
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_unsettled_trial_is_replaced_after_reset():
+    breaker = CircuitBreaker(threshold=1, reset_s=0.1)
+    breaker.record_failure()
+    time.sleep(0.15)
+    assert breaker.allow()  # trial whose outcome is never recorded
+
+    time.sleep(0.15)
+
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_fallback_on_failure_and_when_circuit_open():
+    upstream = Upstream("fake-outage", timeout_s=1.0)
+    upstream.breaker = CircuitBreaker(threshold=2, reset_s=60)
+    failing = fake_remote(0, error=ConnectionError("down"))
+
+    results = [upstream.call(failing, fallback=lambda: "local") for _ in range(4)]
+
+    assert results == ["local"] * 4
+    metrics = upstream.metrics()
+    assert metrics["fallbacks"] == 4
+    assert metrics["failures"] == 2
+    assert metrics["short_circuits"] == 2
+
+
+def test_fallback_on_timeout():
+    upstream = Upstream("fake-slow", timeout_s=0.1)
+
+    result, elapsed = _timed(upstream.call, fake_remote(1000), fallback=lambda: "local")
+
+    assert result == "local"
+    assert elapsed < 0.5
+    assert upstream.metrics()["fallbacks"] == 1
+
+
+def test_answer_cache_serves_previous_answer():
+    cache = AnswerCache(cache=InMemoryCache())
+    cache.put("7", "What is  RAG?", "Retrieval-augmented generation.")
+
+    assert cache.get("7", "what is rag?") == "Retrieval-augmented generation."
+    assert cache.get("8", "what is rag?") is None
+
+
+def test_generation_falls_back_to_smaller_model(monkeypatch):
+    from langchain_core.prompt_values import ChatPromptValue
+    from langchain_core.messages import HumanMessage
+
+    from backend import retreival
+    from backend.generation import GenerationConfig, GenerationProvider
+
+    class FakeProvider(GenerationProvider):
+        def stream(self, messages, config):
+            if config.model == "big":
+                raise ConnectionError("model overloaded")
+            yield f"answer from {config.model}"
+
+    monkeypatch.setattr(retreival, "FALLBACK_MODEL", "small")
+    monkeypatch.setattr(retreival, "get_provider", lambda name=None: FakeProvider())
+    chain = retreival._get_llm_chain(GenerationConfig(provider="fake", model="big"))
+
+    prompt = ChatPromptValue(messages=[HumanMessage(content="hi")])
+    assert "".join(chain.stream(prompt)) == "answer from small"
+
+
+def test_follow_up_is_not_answered_from_another_sessions_cache(monkeypatch):
+    from langchain_core.runnables import RunnableLambda
+
+    from backend import retreival
+
+    def failing_chain(inputs):
+        raise ConnectionError("model overloaded")
+
+    cache = AnswerCache(cache=InMemoryCache())
+    histories = {"a": "", "b": "User: Tell me about section 1."}
+    monkeypatch.setattr(retreival, "answer_cache", cache)
+    monkeypatch.setattr(retreival, "record_turn", lambda *args: None)
+    monkeypatch.setattr(retreival, "get_history_text", histories.get)
+    monkeypatch.setattr(
+        retreival,
+        "_get_retrieval_chain",
+        lambda file_id=None, config=None: RunnableLambda(failing_chain),
+    )
+    # Session "a" once got an answer to this (standalone there) question.
+    cache.put("7", "what about section 2?", "Section 2 of the other file.")
+
+    # In session "b" the same words are a follow-up; the rewrite fails too.
+    monkeypatch.setattr(retreival, "_rewrite_query", lambda q, h, c: q)
+    answer = "".join(retreival.get_streaming_answer("what about section 2?", "7", "b"))
+    assert "Section 2 of the other file." not in answer
+
+    # Once rewritten, the standalone question is what the cache is keyed on.
+    cache.put("7", "What does section 2 of the spec say?", "Cached answer.")
+    monkeypatch.setattr(
+        retreival,
+        "_rewrite_query",
+        lambda q, h, c: "What does section 2 of the spec say?",
+    )
+    answer = "".join(retreival.get_streaming_answer("what about section 2?", "7", "b"))
+    assert "Cached answer." in answer